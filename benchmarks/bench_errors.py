@@ -0,0 +1,52 @@
+"""
+bench_errors.py
+
+Measures the cost of rendering error responses with the body cache warm and with
+it emptied before every error (the previous per-error rendering).
+
+    python benchmarks/bench_errors.py [errors]
+
+"""
+
+import sys
+import timeit
+
+from utilities import exceptions
+from utilities.exceptions import CustomException, ValidationFailed, IntegrityException
+
+
+class DatabaseError(Exception):
+    message = "duplicate key value violates unique constraint\nDETAIL: Key (email)=(a@b.com) already exists."
+
+
+ERRORS = [
+    lambda: CustomException(404, name="Not Found", description="The requested resource was not found"),
+    lambda: CustomException(401, name="Unauthorized", description="Authentication <required>"),
+    lambda: ValidationFailed({"email": ["This field is required"]}),
+    lambda: IntegrityException(DatabaseError()),
+]
+
+
+def render(json_response=False, cold=False):
+    for make in ERRORS:
+        if cold:
+            exceptions._body_cache.clear()
+            exceptions._message_cache.clear()
+        error = make()
+        error.json_response = json_response
+        error.get_response()
+
+
+def main(errors=20000):
+    number = errors // len(ERRORS)
+
+    for label, fn in (("html uncached", lambda: render(cold=True)),
+                      ("html cached", lambda: render()),
+                      ("json uncached", lambda: render(True, cold=True)),
+                      ("json cached", lambda: render(True))):
+        best = min(timeit.repeat(fn, number=number, repeat=3)) / (number * len(ERRORS))
+        print("%-14s %8.1f us/error %10.0f errors/s" % (label, best * 1e6, 1.0 / best))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,41 @@
+"""
+bench_filter_by.py
+
+Measures the per-call overhead of Base.filter_by against an uncached
+`query.filter_by(...).first()` on an in-memory SQLite database.
+
+    python benchmarks/bench_filter_by.py [iterations]
+
+"""
+
+import sys
+import timeit
+
+from utilities import ServiceLabs
+
+from models import app, db, reset, Product
+
+
+def main(iterations=5000):
+    with app.app_context():
+        reset(products=1000)
+
+        ProductService = ServiceLabs.create_instance(Product, db)
+
+        def uncached():
+            i = uncached.i = (uncached.i + 1) % 1000
+            return Product.query.filter_by(slug="product-%d" % i, is_active=True).first()
+
+        def cached():
+            i = cached.i = (cached.i + 1) % 1000
+            return ProductService.filter_by(slug="product-%d" % i, is_active=True)
+
+        uncached.i = cached.i = 0
+
+        for label, fn in (("uncached query.filter_by", uncached), ("cached Base.filter_by", cached)):
+            best = min(timeit.repeat(fn, number=iterations, repeat=3))
+            print("%-26s %8.1f us/call" % (label, best / iterations * 1e6))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,53 @@
+"""
+bench_import.py
+
+Measures the time and resident memory of `import utilities` in a fresh interpreter,
+with the heavy dependencies left lazy and with all of them forced (the previous
+eager behaviour).
+
+    python benchmarks/bench_import.py [runs]
+
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+
+SCRIPT = """
+import json, resource, time
+start = time.time()
+import utilities
+from utilities import utils
+from utilities.utils import slugify
+slugify(u"warm up")
+if %(eager)r:
+    for value in list(vars(utils).values()):
+        if isinstance(value, utils.LazyImport):
+            value._load()
+elapsed = time.time() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"seconds": elapsed, "max_rss_kb": rss}))
+"""
+
+
+def measure(eager, runs):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    results = []
+
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-W", "ignore", "-c", SCRIPT % {"eager": eager}], env=env)
+        results.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+
+    return min(r["seconds"] for r in results), min(r["max_rss_kb"] for r in results)
+
+
+def main(runs=5):
+    for label, eager in (("eager (all dependencies)", True), ("lazy (slugify only)", False)):
+        seconds, rss = measure(eager, runs)
+        print("%-26s %8.1f ms %10d KB max rss" % (label, seconds * 1000, rss))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
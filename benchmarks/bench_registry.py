@@ -0,0 +1,47 @@
+"""
+bench_registry.py
+
+Measures the time to the first filter_by after a deploy with and without
+ServiceLabs.warmup, and the per-call cost of create_instance with the registry.
+
+    python benchmarks/bench_registry.py [calls]
+
+"""
+
+import sys
+import time
+import timeit
+
+from utilities import ServiceLabs
+
+from models import app, db, reset, Product, Category
+
+
+def first_request(warm):
+    ServiceLabs.registry.clear()
+
+    if warm:
+        ServiceLabs.warmup([Product, Category], db)
+
+    start = time.time()
+    ServiceLabs.create_instance(Product, db).filter_by(slug="product-10")
+    ServiceLabs.create_instance(Category, db).filter_by(first_only=False, slug="category-1")
+    return time.time() - start
+
+
+def main(calls=2000):
+    with app.app_context():
+        reset(products=1000)
+
+        for label, warm in (("first request, cold", False), ("first request, warm", True)):
+            best = min(first_request(warm) for _ in range(5))
+            print("%-30s %8.1f us" % (label, best * 1e6))
+
+        for label, fn in (("build_instance per call", lambda: ServiceLabs.build_instance(Product, db)),
+                          ("create_instance per call", lambda: ServiceLabs.create_instance(Product, db))):
+            best = min(timeit.repeat(fn, number=calls, repeat=3)) / calls
+            print("%-30s %8.1f us" % (label, best * 1e6))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
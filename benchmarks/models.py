@@ -0,0 +1,47 @@
+"""
+models.py
+
+SQLite backed flask app and models shared by the benchmarks
+"""
+
+import os
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+
+app = Flask(__name__)
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("BENCH_DATABASE_URI", "sqlite://")
+app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+db = SQLAlchemy(app)
+
+
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200))
+    slug = db.Column(db.String(200), index=True)
+    products = db.relationship("Product", backref="category", lazy="dynamic")
+
+
+class Product(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), index=True)
+    slug = db.Column(db.String(200), index=True)
+    sku = db.Column(db.String(50))
+    price = db.Column(db.Float, default=0.0)
+    views = db.Column(db.Integer, default=0)
+    is_active = db.Column(db.Boolean, default=True)
+    category_id = db.Column(db.Integer, db.ForeignKey("category.id"))
+
+
+def reset(products=0, categories=10):
+    """ recreate the tables and insert the given number of rows """
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(Category, [
+        {"id": i, "name": "category %d" % i, "slug": "category-%d" % i} for i in range(1, categories + 1)])
+    db.session.bulk_insert_mappings(Product, [
+        {"id": i, "name": "product %d" % i, "slug": "product-%d" % i, "sku": "SKU%06d" % i, "price": i * 1.25,
+         "category_id": 1 + i % categories} for i in range(1, products + 1)])
+    db.session.commit()
@@ -0,0 +1,295 @@
+"""
+suite.py
+
+Benchmarks for the utilities hot paths. Results are written as json and can be
+compared against a stored baseline to flag regressions.
+
+    python benchmarks/suite.py                                # run everything
+    python benchmarks/suite.py slugify loader                 # run benchmarks whose name contains a filter
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --save-baseline benchmarks/baseline.json
+    python benchmarks/suite.py --compare benchmarks/baseline.json --threshold 0.15
+
+The exit status is 1 when a benchmark is slower than the baseline by more than the threshold.
+"""
+
+import os
+import sys
+import json
+import random
+import platform
+import argparse
+import tempfile
+import timeit
+from datetime import datetime, date, timedelta
+from contextlib import contextmanager
+
+from utilities import utils, loader, ServiceLabs
+
+import models
+
+
+BENCHMARKS = []
+
+WORDS = (u"the quick brown fox jumps over lazy dog caf\xe9 na\xefve r\xe9sum\xe9 lagos abuja market price "
+         u"sale & discount 50% off (limited) today's best/deals").split()
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.102 "
+    "Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 12_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+    "Version/12.0 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (iPad; CPU OS 11_0 like Mac OS X) AppleWebKit/604.1.34 (KHTML, like Gecko) Version/11.0 "
+    "Mobile/15A5341f Safari/604.1",
+    "Mozilla/5.0 (Linux; Android 8.0.0; SM-G960F Build/R16NW) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/62.0.3202.84 Mobile Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.0.1 "
+    "Safari/605.1.15",
+]
+
+
+def benchmark(name, number=1000, before=None):
+    """
+    register a benchmark. the decorated function does the setup and returns the callable to time
+
+    :param name: benchmark name
+    :param number: calls per timing run
+    :param before: optional callable run before each timing run, not timed
+    """
+    def decorator(setup):
+        BENCHMARKS.append((name, number, setup, before))
+        return setup
+    return decorator
+
+
+@contextmanager
+def quiet():
+    """ silence the helpers that print their input """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def sentence(rng, words):
+    return u" ".join(rng.choice(WORDS) for _ in range(words))
+
+
+@benchmark("slugify", number=2000)
+def bench_slugify():
+    rng = random.Random(1)
+    titles = [sentence(rng, 10) for _ in range(100)]
+    return lambda: [utils.slugify(t) for t in titles]
+
+
+@benchmark("normalize_text", number=20)
+def bench_normalize_text():
+    rng = random.Random(2)
+    paragraphs = [sentence(rng, 80) for _ in range(100)]
+    return lambda: [utils.normalize_text(p) for p in paragraphs]
+
+
+@benchmark("clean_ascii", number=500)
+def bench_clean_ascii():
+    rng = random.Random(3)
+    texts = [sentence(rng, 30).encode("utf-8") for _ in range(100)]
+    return lambda: [utils.clean_ascii(t) for t in texts]
+
+
+@benchmark("format_phone_numbers", number=20)
+def bench_format_phone_numbers():
+    rng = random.Random(4)
+    numbers = ["080%08d or 0703%07d / +234 805 %03d %04d" % (rng.randint(0, 10 ** 8 - 1), rng.randint(0, 10 ** 7 - 1),
+                                                              rng.randint(0, 999), rng.randint(0, 9999))
+               for _ in range(100)]
+    return lambda: [utils.format_phone_numbers(n, "NG") for n in numbers]
+
+
+@benchmark("detect_user_device", number=5)
+def bench_detect_user_device():
+    agents = USER_AGENTS * 20
+    return lambda: [utils.detect_user_device(ua) for ua in agents]
+
+
+def _record(rng):
+    return dict(("field_%d" % i, sentence(rng, 3).encode("utf-8")) for i in range(10))
+
+
+@benchmark("encrypt_data_3des", number=100)
+def bench_encrypt_data_3des():
+    record = _record(random.Random(5))
+
+    def run():
+        with quiet():
+            return utils.decrypt_data("secret", utils.encrypt_data("secret", record))
+    return run
+
+
+@benchmark("encrypt_data_pyaes", number=20)
+def bench_encrypt_data_pyaes():
+    record = _record(random.Random(6))
+
+    def run():
+        with quiet():
+            return utils.decrypt_data_pyaes("secret", utils.encrypt_data_pyaes("secret", record))
+    return run
+
+
+@benchmark("date_json_encoder", number=20)
+def bench_date_json_encoder():
+    start = datetime(2018, 1, 1)
+    rows = [{"id": i, "name": "row %d" % i, "date_created": start + timedelta(minutes=i),
+             "due": date(2018, 1, 1) + timedelta(days=i % 365), "amount": i * 1.5} for i in range(1000)]
+    return lambda: json.dumps(rows, cls=utils.DateJSONEncoder)
+
+
+@benchmark("object_payload", number=200)
+def bench_object_payload():
+    data = {"id": 1, "user": {"name": "test", "address": {"city": "lagos", "lines": ["a", "b"]}},
+            "items": [{"sku": "SKU%d" % i, "price": i, "tags": [{"name": "t"}]} for i in range(50)]}
+    return lambda: utils.ObjectPayload(data)
+
+
+def _service():
+    models.reset(products=10000)
+    return ServiceLabs.create_instance(models.Product, models.db)
+
+
+@benchmark("service_get", number=2000)
+def bench_service_get():
+    service = _service()
+    rng = random.Random(7)
+    it = iter([rng.randint(1, 10000) for _ in range(2000)] * 100)
+
+    def run():
+        # empty the identity map so get queries the database
+        models.db.session.expunge_all()
+        return service.get(next(it))
+    return run
+
+
+@benchmark("service_filter_by", number=2000)
+def bench_service_filter_by():
+    service = _service()
+    rng = random.Random(8)
+    it = iter(["product-%d" % rng.randint(1, 10000) for _ in range(2000)] * 100)
+    return lambda: service.filter_by(slug=next(it), is_active=True)
+
+
+@benchmark("service_get_by_ids", number=200)
+def bench_service_get_by_ids():
+    service = _service()
+    ids = range(1, 10000, 50)
+    return lambda: service.get_by_ids(ids).all()
+
+
+@benchmark("service_create_update", number=200)
+def bench_service_create_update():
+    service = _service()
+    counter = iter(range(10 ** 7))
+
+    def run():
+        i = next(counter)
+        obj = service.create(name="new product %d" % i, slug="new-product-%d" % i, price=1.0)
+        return service.update(obj.id, price=2.0)
+    return run
+
+
+@benchmark("loader_load_data", number=1, before=lambda: models.reset(categories=0))
+def bench_loader_load_data():
+    fixture = {"model": "Category", "objects": [
+        {"name": "category %d" % i, "slug": "category-%d" % i, "children": [
+            {"model": "Product", "property": "products", "parent": "category_id",
+             "objects": [{"name": "product %d-%d" % (i, j), "sku": "S%d-%d" % (i, j)} for j in range(5)]}]}
+        for i in range(2000)]}
+
+    handle, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(handle, "w") as f:
+        json.dump(fixture, f)
+
+    return lambda: loader.load_data(models, models.db, path, stream=True)
+
+
+def run(filters=(), repeat=3):
+    """
+    run the registered benchmarks
+
+    :param filters: only run benchmarks whose name contains one of these
+    :param repeat: timing runs per benchmark, the best is kept
+    :return: dict of name -> result
+    """
+    results = {}
+
+    with models.app.app_context():
+        for name, number, setup, before in BENCHMARKS:
+            if filters and not any(f in name for f in filters):
+                continue
+
+            fn = setup()
+            if before:
+                before()
+            fn()
+            best = min(timeit.repeat(fn, setup=before or "pass", number=number, repeat=repeat)) / number
+            results[name] = {"seconds_per_call": best, "calls_per_second": 1.0 / best, "number": number}
+            print("%-24s %12.1f us/call %12.1f calls/s" % (name, best * 1e6, 1.0 / best))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    compare results with a baseline
+    :return: list of (name, ratio) for the benchmarks slower than the baseline by more than threshold
+    """
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            continue
+
+        ratio = result["seconds_per_call"] / previous["seconds_per_call"]
+        flag = "REGRESSION" if ratio > 1 + threshold else ""
+        print("%-24s %+8.1f%% %s" % (name, (ratio - 1) * 100, flag))
+
+        if flag:
+            regressions.append((name, ratio))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="utilities benchmarks")
+    parser.add_argument("filters", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--save-baseline", help="write the results as the baseline to this file")
+    parser.add_argument("--compare", help="baseline file to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown as a fraction")
+    args = parser.parse_args(argv)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.utcnow().isoformat(),
+        "results": run(args.filters, args.repeat)
+    }
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report["results"], json.load(f), args.threshold)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
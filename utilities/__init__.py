@@ -1,5 +1,14 @@
 from utilities.utils import *
+from utilities import profiling
 from logging import handlers, INFO, Formatter, getLogger
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+
+# cached counts per service class, expired counts are purged when it is full
+COUNT_CACHE_SIZE = 1024
 
 
 class ObjectNotFoundException(Exception):
@@ -12,8 +21,69 @@ class ObjectNotFoundException(Exception):
         super(ObjectNotFoundException, self).__init__(message)
 
 
+class Pagination(object):
+    """ a page of results with its totals and page links """
+
+    def __init__(self, items, page, per_page, total, url_template=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.pages = (total + per_page - 1) // per_page if per_page else 0
+        self.url_template = url_template
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+    def url(self, page):
+        return self.url_template(page) if self.url_template else None
+
+    def iter_pages(self, window=2):
+        """ page numbers around the current page """
+        return range(max(1, self.page - window), min(self.pages, self.page + window) + 1)
+
+
+class ServiceMeta(type):
+    """
+    metaclass for generated service classes. resolves the `<name>_view_query` functions
+    once when a service class (or a subclass of it) is created rather than on every request
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(ServiceMeta, cls).__init__(name, bases, attrs)
+        cls._resolve_views()
+
+    def __setattr__(cls, name, value):
+        super(ServiceMeta, cls).__setattr__(name, value)
+        if name.endswith("_view_query"):
+            cls._resolve_views()
+
+    @property
+    def query(cls):
+        """ the model query, bound to the session current when it is accessed """
+        return cls.model_class.query
+
+    def _resolve_views(cls):
+        views = {}
+        for attr in dir(cls):
+            if attr.endswith("_view_query"):
+                views[attr[:-len("_view_query")]] = getattr(cls, attr)
+        type.__setattr__(cls, "_view_funcs", views)
+
+
 class ServiceLabs(object):
 
+    # one service class per (model class, db). the classes only hold session independent
+    # data, queries are resolved against the current session on each access (ServiceMeta.query)
+    registry = {}
+    registry_lock = threading.Lock()
+    pool = None
+
     @staticmethod
     def setup_log(log_name, log_file, level=INFO):
         """
@@ -57,12 +127,69 @@ class ServiceLabs(object):
     @classmethod
     def create_instance(cls, class_obj, db):
         """
-        creates a service class instance for a model class
+        returns the service class for a model class, building it on first use
+        :param class_obj:
+        :param db:
+        :return: model service class
+        """
+        key = (class_obj, db)
+        service = cls.registry.get(key)
+
+        if service is None:
+            with cls.registry_lock:
+                service = cls.registry.get(key)
+                if service is None:
+                    service = cls.registry[key] = cls.build_instance(class_obj, db)
+
+        return service
+
+    @classmethod
+    def worker_pool(cls, size=4):
+        """
+        thread pool shared by the service classes for queries run alongside a request's own
+        :return: ThreadPool
+        """
+        if cls.pool is None:
+            with cls.registry_lock:
+                if cls.pool is None:
+                    cls.pool = ThreadPool(size)
+        return cls.pool
+
+    @classmethod
+    def warmup(cls, models, db, filters=None):
+        """
+        builds and prepares the service classes of models at boot so the first requests
+        do not pay for class creation, metadata lookups and query compilation
+        :param models: model classes
+        :param db:
+        :param filters: optional dict of model class -> filter shapes (tuples of column names) to compile.
+            defaults to the primary key and the unique or indexed columns
+        :return: list of service classes
+        """
+        services = []
+
+        with db.get_app().app_context():
+            for class_obj in models:
+                service = cls.create_instance(class_obj, db)
+                service.prepare((filters or {}).get(class_obj))
+                services.append(service)
+
+        return services
+
+    @classmethod
+    def build_instance(cls, class_obj, db):
+        """
+        creates a new service class for a model class
         :param class_obj:
         :param db:
         :return: model service class
         """
+        from sqlalchemy import bindparam, func, select
+        from sqlalchemy.ext import baked
+        from sqlalchemy.orm import scoped_session, class_mapper, Query
+
         class Base(object):
+            __metaclass__ = ServiceMeta
 
             @classmethod
             def create(cls, ignored=None, **kwargs):
@@ -161,13 +288,267 @@ class ServiceLabs(object):
                 :return:
                 """
                 try:
-                    query = Base.query.filter_by(**kwargs)
+                    result = Base.filter_query(first_only, **kwargs).all()
                     if not first_only:
-                        return query.all()
-                    return query.first()
+                        return result
+                    return result[0] if result else None
                 except:
                     return None if first_only else list()
 
+            @classmethod
+            def filter_query(cls, first_only=True, **kwargs):
+                """
+                return a baked query for kwargs with its values bound. the compiled statement is
+                cached on the shape of the filter (column names, null checks and first_only).
+                filters on anything but columns (e.g. relationships), or models whose query class
+                changes how rows are fetched, go through Base.query.filter_by instead.
+                with first_only the query is limited to one row
+                :param first_only:
+                :param kwargs:
+                :return: baked query result or query
+                """
+                if Base.columns is None:
+                    Base.prepare(filters=())
+
+                if not Base.bakeable or not Base.column_set.issuperset(kwargs):
+                    query = Base.query.filter_by(**kwargs)
+                    return query.limit(1) if first_only else query
+
+                columns = tuple(sorted((k, v is None) for k, v in kwargs.items()))
+                bq = Base.filter_template(columns, first_only)
+                params = dict(("fb_%s" % k, v) for k, v in kwargs.items() if v is not None)
+
+                return bq(Base.session()).params(**params)
+
+            @classmethod
+            def filter_template(cls, columns, first_only=True):
+                """
+                return the baked query for a filter shape, building it on first use
+                :param columns: sorted tuple of (column name, is null check)
+                :param first_only:
+                :return: baked query
+                """
+                shape = (columns, first_only)
+                bq = Base.filter_cache.get(shape)
+
+                if bq is None:
+                    criteria = dict((k, None if is_null else bindparam("fb_%s" % k)) for k, is_null in columns)
+                    bq = Base.bakery(lambda session: query_class(class_mapper(class_obj), session=session), class_obj)
+                    bq.add_criteria(lambda query: query.filter_by(**criteria), shape)
+                    if first_only:
+                        bq.add_criteria(lambda query: query.limit(1))
+                    Base.filter_cache[shape] = bq
+
+                return bq
+
+            @classmethod
+            def prepare(cls, filters=None):
+                """
+                precompute the column metadata and attribute plan of the model and compile the
+                queries of the filter shapes. called by warmup, or on first use otherwise
+                :param filters: filter shapes (tuples of column names), defaults to the primary key
+                    and the unique or indexed columns
+                :return: service class
+                """
+                mapper = class_mapper(class_obj)
+                Base.columns = tuple(prop.key for prop in mapper.column_attrs)
+                Base.column_set = frozenset(Base.columns)
+                Base.primary_key = tuple(mapper.get_property_by_column(c).key for c in mapper.primary_key)
+                Base.attributes = frozenset(name for name in dir(class_obj) if not name.startswith("__"))
+
+                if filters is None:
+                    filters = [Base.primary_key] + [(prop.key,) for prop in mapper.column_attrs
+                                                    if any(c.unique or c.index for c in prop.columns)]
+
+                for shape in filters:
+                    for first_only in (True, False):
+                        bq = Base.filter_template(tuple(sorted((k, False) for k in shape)), first_only)
+                        # compiles the query into the bakery cache without running it
+                        bq._bake(Base.session())
+
+                return Base
+
+            @classmethod
+            def session(cls):
+                """
+                return the session used by the service class
+                :return: session
+                """
+                session = Base.conn.session
+                return session() if isinstance(session, scoped_session) else session
+
+            @classmethod
+            def filter_by_blind_index(cls, key, first_only=True, suffix="_bidx", normalize=None, **kwargs):
+                """
+                query a model by the plain values of encrypted fields. each value is matched
+                against the blind index column `<field><suffix>` instead of decrypting the rows
+                :param key: blind index secret
+                :param normalize: optional function applied to the values before hashing
+                :param kwargs: plain field values
+                :return:
+                """
+                filters = dict(("%s%s" % (k, suffix), blind_index(key, v, normalize)) for k, v in kwargs.items())
+                return Base.filter_by(first_only=first_only, **filters)
+
+            @classmethod
+            def iter_values(cls, *columns, **kwargs):
+                """
+                stream only the given columns of the rows matching kwargs straight from the cursor,
+                without building model objects
+                :param columns: column names, defaults to all the columns
+                :param kwargs: filters. view_name applies the matching view query, named=True yields
+                    namedtuples instead of tuples and batch_size sets the rows fetched at a time
+                :return: generator of rows
+                """
+                view_name = kwargs.pop("view_name", None)
+                named = kwargs.pop("named", False)
+                batch_size = kwargs.pop("batch_size", 1000)
+
+                if not columns:
+                    if Base.columns is None:
+                        Base.prepare(filters=())
+                    columns = Base.columns
+
+                query = cls.view_filter(Base.query, view_name).filter_by(**kwargs)
+                statement = query.with_entities(*[getattr(class_obj, c) for c in columns]).statement
+                result = Base.session().execute(statement)
+                make = namedtuple("%sRow" % class_obj.__name__, columns)._make if named else tuple
+
+                try:
+                    while True:
+                        rows = result.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        for row in rows:
+                            yield make(row)
+                finally:
+                    result.close()
+
+            @classmethod
+            def values(cls, *columns, **kwargs):
+                """
+                return only the given columns of the rows matching kwargs, without building model objects
+                :param columns: column names, defaults to all the columns
+                :param kwargs: filters and the options of iter_values. as_columns=True returns a dict of
+                    column name -> list of values instead of a list of rows
+                :return: list of rows or dict of columns
+                """
+                as_columns = kwargs.pop("as_columns", False)
+                rows = list(cls.iter_values(*columns, **kwargs))
+
+                if not as_columns:
+                    return rows
+
+                names = columns or Base.columns
+                arrays = zip(*rows) if rows else [()] * len(names)
+                return dict((name, list(array)) for name, array in zip(names, arrays))
+
+            @classmethod
+            def count(cls, view_name=None, ttl=30, **kwargs):
+                """
+                count the rows matching kwargs. counts are cached per view and filter for ttl seconds
+                :param view_name:
+                :param ttl: seconds to reuse a count, 0 to always count
+                :param kwargs: filters
+                :return: count
+                """
+                key = Base.count_key(view_name, kwargs)
+                total = Base.cached_count(key)
+
+                if total is None:
+                    total = Base.session().execute(Base.count_statement(view_name, **kwargs)).scalar()
+                    Base.store_count(key, total, ttl)
+
+                return total
+
+            @classmethod
+            def count_key(cls, view_name, filters):
+                """ cache key of a count, None when a filter value cannot be hashed """
+                key = (view_name, tuple(sorted(filters.items())))
+                try:
+                    hash(key)
+                except TypeError:
+                    return None
+                return key
+
+            @classmethod
+            def cached_count(cls, key):
+                cached = Base.count_cache.get(key) if key is not None else None
+                if cached and cached[0] > time.time():
+                    return cached[1]
+                return None
+
+            @classmethod
+            def store_count(cls, key, total, ttl):
+                """ cache a count. when the cache is full expired counts are purged, then all of them """
+                if key is None or not ttl:
+                    return
+
+                now = time.time()
+                with Base.count_lock:
+                    if len(Base.count_cache) >= COUNT_CACHE_SIZE:
+                        for k, (expires, _) in list(Base.count_cache.items()):
+                            if expires <= now:
+                                del Base.count_cache[k]
+                        if len(Base.count_cache) >= COUNT_CACHE_SIZE:
+                            Base.count_cache.clear()
+
+                    Base.count_cache[key] = (now + ttl, total)
+
+            @classmethod
+            def count_statement(cls, view_name=None, **kwargs):
+                query = cls.view_filter(Base.query, view_name).filter_by(**kwargs).order_by(None)
+                return select([func.count()]).select_from(query.statement.alias())
+
+            @classmethod
+            def paginate(cls, page=1, per_page=20, path=None, url_args=None, view_name=None, count_ttl=30,
+                         order_by=None, **kwargs):
+                """
+                return a page of the rows matching kwargs. the total count is cached for count_ttl seconds
+                and when it has to be counted it runs on a worker thread while the page is fetched
+                :param page: page number, starting at 1
+                :param per_page:
+                :param path: path of the listing, to build the page links
+                :param url_args: query string arguments of the listing (e.g. request.args)
+                :param view_name:
+                :param count_ttl: seconds to reuse a count
+                :param order_by: column or list of columns to order by. the primary key is always added
+                    last so pages are stable
+                :param kwargs: filters
+                :return: Pagination
+                """
+                page = max(1, int(page))
+                key = Base.count_key(view_name, kwargs)
+                total = Base.cached_count(key)
+                pending = None
+
+                if total is None:
+                    statement = cls.count_statement(view_name, **kwargs)
+                    app = Base.conn.get_app()
+
+                    def _count():
+                        with app.app_context():
+                            try:
+                                return Base.session().execute(statement).scalar()
+                            finally:
+                                Base.conn.session.remove()
+
+                    pending = ServiceLabs.worker_pool().apply_async(_count)
+
+                query = cls.view_filter(Base.query, view_name).filter_by(**kwargs)
+                if order_by is not None:
+                    query = query.order_by(*(order_by if isinstance(order_by, (list, tuple)) else [order_by]))
+                query = query.order_by(*class_mapper(class_obj).primary_key)
+                items = query.limit(per_page).offset((page - 1) * per_page).all()
+
+                if pending is not None:
+                    total = pending.get()
+                    Base.store_count(key, total, count_ttl)
+
+                urls = PageUrlTemplate(path, url_args or {}) if path is not None else None
+
+                return Pagination(items, page, per_page, total, urls)
+
             @classmethod
             def view_filter(cls, query, view_name=None, **kwargs):
                 """
@@ -176,13 +557,38 @@ class ServiceLabs(object):
                 :return:
                 """
                 try:
-                    view_func = getattr(cls, "%s_view_query" % view_name.lower(), None) if view_name else None
+                    view_func = cls._view_funcs.get(view_name.lower()) if view_name else None
                     return view_func(query) if view_func else query
 
                 except Exception as e:
                     print(e)
                     return Base.query
 
+            @classmethod
+            def export(cls, fileobj, format="csv", columns=None, batch_size=1000, formatters=None, query=None,
+                       **kwargs):
+                """
+                stream the model rows matching kwargs to a file-like object as csv or json.
+                rows are read from the database and written batch_size at a time
+                :param fileobj: file-like object to write to
+                :param format: "csv" or "json"
+                :param columns: names of the columns to export, defaults to all the columns
+                :param formatters: dict of column name -> function replacing the default formatting
+                :param query: optional query to export instead of Base.query
+                :param kwargs: filters
+                :return: number of rows written
+                """
+                if not columns:
+                    if Base.columns is None:
+                        Base.prepare(filters=())
+                    columns = Base.columns
+
+                query = (query or Base.query).filter_by(**kwargs)
+                rows = query.with_entities(*[getattr(class_obj, c) for c in columns]) \
+                    .execution_options(stream_results=True).yield_per(batch_size)
+
+                return export_rows(fileobj, format, columns, rows, batch_size, formatters)
+
             @classmethod
             def delete(cls, obj_id):
                 """
@@ -228,8 +634,10 @@ class ServiceLabs(object):
                 :return:
                 """
                 # clean kwargs
-                data = clean_kwargs(ignored, kwargs)
-                data = remove_invalid_attributes(Base.model_class(), data)
+                data = clean_kwargs(ignored or (), kwargs)
+                if Base.attributes is None:
+                    Base.prepare(filters=())
+                data = dict((k, v) for k, v in data.items() if k in Base.attributes)
 
                 try:
                     res = Base.query.filter(Base.model_class.id.in_(ids)).update(data, synchronize_session=False)
@@ -239,6 +647,39 @@ class ServiceLabs(object):
                     Base.conn.session.rollback()
                     raise
 
+            @classmethod
+            def unique_slugs(cls, field, texts, save=None, retries=3):
+                """
+                allocate unique slugs for texts against the existing values of field and each other
+                :param field: slug column
+                :param texts:
+                :param save: optional callable writing the rows with the slugs, retried on conflicts
+                :param retries:
+                :return: list of slugs
+                """
+                from utilities.loader import unique_slugs
+
+                return unique_slugs(Base.model_class, field, texts, save, retries)
+
+            @classmethod
+            def write_buffer(cls, max_pending=1000, flush_interval=1.0):
+                """
+                return the write-behind buffer of the service, starting it on first use. increments
+                and updates buffered there are coalesced per id and written in batches
+                :param max_pending: number of buffered ids that triggers a flush
+                :param flush_interval: seconds between flushes
+                :return: WriteBuffer
+                """
+                if Base.buffer is None:
+                    with ServiceLabs.registry_lock:
+                        if Base.buffer is None:
+                            from utilities.writebuffer import WriteBuffer
+
+                            engine = Base.conn.get_engine(Base.conn.get_app())
+                            Base.buffer = WriteBuffer(Base.model_class, engine, max_pending, flush_interval).start()
+
+                return Base.buffer
+
             @classmethod
             def delete_by_ids(cls, ids=None):
                 """
@@ -261,8 +702,25 @@ class ServiceLabs(object):
                         raise
                 return True
 
+        # the baked filters build their query from the model's query class, unless it overrides how
+        # rows are fetched, which baked queries bypass
+        query_class = getattr(class_obj, "query_class", None) or Query
+        Base.bakeable = all("__iter__" not in vars(k) for k in query_class.__mro__[:query_class.__mro__.index(Query)])
+
         Base.model_class = class_obj
         Base.conn = db
-        Base.query = Base.model_class.query
+        Base.bakery = baked.bakery()
+        Base.filter_cache = {}
+        Base.columns = None
+        Base.primary_key = None
+        Base.attributes = None
+        Base.count_cache = {}
+        Base.count_lock = threading.Lock()
+        Base.buffer = None
+
+        profiling.register_class(Base, "%sService" % class_obj.__name__)
 
         return Base
+
+
+profiling.configure()
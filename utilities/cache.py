@@ -0,0 +1,355 @@
+"""
+cache.py
+
+Cache backends for the expensive helpers in utilities.utils (compute_lat_lng,
+detect_user_agent and render_domain_template).
+
+Nothing is cached until a backend is configured:
+
+    >>> from utilities import cache
+    >>> cache.configure(cache.MemoryCache(max_size=50000))
+
+or, to share results across processes and hosts, with MongoDB behind a small in-process cache:
+
+    >>> collection = pymongo.MongoClient()["utilities"]["cache"]
+    >>> cache.configure(cache.TieredCache(cache.MemoryCache(), cache.MongoCache(collection)))
+
+Memoized helpers also get a `many` function that looks up a batch of arguments with a
+single get_many and stores the misses with a single set_many
+
+    >>> utils.compute_lat_lng.many([("12 Broad St, Lagos",), ("1 Marina, Lagos",)])
+
+render_domain_template results are keyed on the template name and arguments only, so it is
+only cached when named in configure(helpers=[...]). Do not enable it for templates that
+depend on the request (context processors, current user...).
+
+A backend error (e.g. MongoDB being down) is logged and the helper computes the value.
+"""
+
+import time
+import pickle
+import calendar
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+_settings = {"backend": None, "helpers": None}
+
+_missing = object()
+
+
+class CacheBackend(object):
+    """ interface of the cache backends. get_many and set_many fall back to single calls """
+
+    def get(self, key):
+        """ return the cached value or None """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """
+        :param ttl: seconds to keep the value, defaults to the backend's default_ttl
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """ return a dict of key -> value for the keys found """
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set_many(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def get_entries(self, keys):
+        """ return a dict of key -> (expiry timestamp or None, value) for the keys found """
+        return dict((key, (None, value)) for key, value in self.get_many(keys).items())
+
+
+class MemoryCache(CacheBackend):
+    """ in-process cache, least recently used entries are evicted past max_size """
+
+    def __init__(self, max_size=10000, default_ttl=None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+
+            if entry[0] is not None and entry[0] < time.time():
+                return None
+
+            self._data[key] = entry
+            return entry[1]
+
+    def get_entries(self, keys):
+        now = time.time()
+        result = {}
+
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is not None and (entry[0] is None or entry[0] >= now):
+                    result[key] = entry
+
+        return result
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl if ttl else None, value)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class MongoCache(CacheBackend):
+    """
+    cache stored in a MongoDB collection. values are pickled, expired documents are removed
+    by a TTL index on expires_at (and ignored on read until the TTL monitor gets to them)
+    """
+
+    def __init__(self, collection, default_ttl=86400):
+        """
+        :param collection: pymongo collection, or a MemoryCollection for testing
+        :param default_ttl: seconds to keep values
+        """
+        self.collection = collection
+        self.default_ttl = default_ttl
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def _document(self, key, value, ttl):
+        from bson.binary import Binary
+
+        ttl = self.default_ttl if ttl is None else ttl
+        return {"_id": key, "value": Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                "expires_at": datetime.utcnow() + timedelta(seconds=ttl)}
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        return dict((key, entry[1]) for key, entry in self.get_entries(keys).items())
+
+    def get_entries(self, keys):
+        if not keys:
+            return {}
+
+        cursor = self.collection.find({"_id": {"$in": list(keys)}, "expires_at": {"$gt": datetime.utcnow()}})
+        return dict((doc["_id"], (calendar.timegm(doc["expires_at"].utctimetuple()),
+                                  pickle.loads(bytes(doc["value"])))) for doc in cursor)
+
+    def set(self, key, value, ttl=None):
+        self.collection.replace_one({"_id": key}, self._document(key, value, ttl), upsert=True)
+
+    def set_many(self, mapping, ttl=None):
+        from pymongo import ReplaceOne
+
+        if mapping:
+            self.collection.bulk_write([ReplaceOne({"_id": key}, self._document(key, value, ttl), upsert=True)
+                                        for key, value in mapping.items()], ordered=False)
+
+    def delete(self, key):
+        self.collection.delete_one({"_id": key})
+
+
+class TieredCache(CacheBackend):
+    """ a local cache in front of a shared one. hits on the shared cache are copied locally """
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        return dict((key, entry[1]) for key, entry in self.get_entries(keys).items())
+
+    def get_entries(self, keys):
+        result = self.local.get_entries(keys)
+        missing = [key for key in keys if key not in result]
+
+        if missing:
+            found = self.shared.get_entries(missing)
+            now = time.time()
+
+            # copied with the time they have left in the shared cache
+            for key, (expires, value) in found.items():
+                if expires is None:
+                    self.local.set(key, value)
+                elif expires > now:
+                    self.local.set(key, value, expires - now)
+
+            result.update(found)
+
+        return result
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping, ttl=None):
+        self.shared.set_many(mapping, ttl)
+        # the local copies expire with the shared ones
+        self.local.set_many(mapping, ttl if ttl is not None else getattr(self.shared, "default_ttl", None))
+
+    def delete(self, key):
+        self.shared.delete(key)
+        self.local.delete(key)
+
+
+class MemoryCollection(object):
+    """ in-memory stand-in for the parts of a pymongo collection MongoCache uses """
+
+    def __init__(self):
+        self.documents = {}
+        self.indexes = []
+
+    def create_index(self, key, **kwargs):
+        self.indexes.append((key, kwargs))
+
+    def find(self, spec):
+        ids = spec["_id"]["$in"]
+        after = spec["expires_at"]["$gt"]
+        return [self.documents[i] for i in ids if i in self.documents and self.documents[i]["expires_at"] > after]
+
+    def replace_one(self, spec, document, upsert=False):
+        if upsert or spec["_id"] in self.documents:
+            self.documents[spec["_id"]] = document
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.replace_one(request._filter, request._doc, request._upsert)
+
+    def delete_one(self, spec):
+        self.documents.pop(spec["_id"], None)
+
+
+def configure(backend, helpers=None):
+    """
+    set the cache backend used by the memoized helpers
+
+    :param backend: CacheBackend, None to stop caching
+    :param helpers: names of the helpers to cache, defaults to all of them except the opt-in ones
+        (render_domain_template)
+    """
+    _settings["backend"] = backend
+    _settings["helpers"] = set(helpers) if helpers is not None else None
+
+
+def get_backend():
+    return _settings["backend"]
+
+
+def _backend(namespace, opt_in=False):
+    backend = _settings["backend"]
+    helpers = _settings["helpers"]
+
+    if backend is None:
+        return None
+    if helpers is None:
+        return None if opt_in else backend
+    return backend if namespace in helpers else None
+
+
+def make_key(namespace, args, kwargs=None):
+    """ cache key of a call, a hash of its arguments under the helper's namespace """
+    data = repr((args, sorted(kwargs.items()) if kwargs else ()))
+    return "%s:%s" % (namespace, hashlib.sha1(data).hexdigest())
+
+
+def memoize(namespace, ttl=None, opt_in=False):
+    """
+    cache the results of a function in the configured backend. None results are not cached and
+    backend errors are logged, the function is then called as if the cache missed
+
+    :param namespace: key prefix, also the name used by configure(helpers=...)
+    :param ttl: seconds to keep results, defaults to the backend's default_ttl
+    :param opt_in: only cache when the namespace is named in configure(helpers=...)
+    """
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            backend = _backend(namespace, opt_in)
+            if backend is None:
+                return func(*args, **kwargs)
+
+            key = make_key(namespace, args, kwargs)
+            try:
+                value = backend.get(key)
+            except Exception as e:
+                logger.error("Cache get failed for %s: %s", namespace, e)
+                return func(*args, **kwargs)
+
+            if value is None:
+                value = func(*args, **kwargs)
+                if value is not None:
+                    try:
+                        backend.set(key, value, ttl)
+                    except Exception as e:
+                        logger.error("Cache set failed for %s: %s", namespace, e)
+
+            return value
+
+        def many(calls):
+            """
+            :param calls: list of argument tuples
+            :return: list of results in the same order
+            """
+            calls = [tuple(args) for args in calls]
+            backend = _backend(namespace, opt_in)
+            if backend is None:
+                return [func(*args) for args in calls]
+
+            keys = [make_key(namespace, args) for args in calls]
+            try:
+                found = backend.get_many(list(set(keys)))
+            except Exception as e:
+                logger.error("Cache get failed for %s: %s", namespace, e)
+                found = {}
+
+            computed = {}
+            for key, args in zip(keys, calls):
+                if key not in found and key not in computed:
+                    computed[key] = func(*args)
+
+            try:
+                backend.set_many(dict((k, v) for k, v in computed.items() if v is not None), ttl)
+            except Exception as e:
+                logger.error("Cache set failed for %s: %s", namespace, e)
+            found.update(computed)
+
+            return [found[key] for key in keys]
+
+        wrapper.many = many
+        return wrapper
+
+    return decorator
@@ -1,3 +1,5 @@
+import json
+
 from werkzeug.exceptions import HTTPException
 from werkzeug.utils import escape
 from werkzeug.wrappers import Response
@@ -8,8 +10,73 @@ INTEGRITY_ERROR = 408
 VALIDATION_FAILED = 409
 ACTION_REQUIRED = 209
 
+# rendered bodies are cached per (class, code, name, description), the cache is emptied when full
+BODY_CACHE_SIZE = 1024
+_body_cache = {}
+_message_cache = {}
+
+
+def _cached(cache, key, render):
+    value = cache.get(key)
+    if value is None:
+        if len(cache) >= BODY_CACHE_SIZE:
+            cache.clear()
+        value = cache[key] = render()
+    return value
+
+
+class CachedResponseMixin(object):
+    """
+    Renders the error body once per (class, code, name, description) and reuses the encoded
+    body for every response. Set json_response on the class or the instance to get a compact
+    json body, which includes the exception data, instead of html
+    """
+
+    json_response = False
+
+    def get_title(self):
+        return self.name
+
+    def cache_key(self):
+        return type(self), self.code, self.get_title(), self.description
+
+    def render_body(self, environ=None):
+        return super(CachedResponseMixin, self).get_body(environ)
 
-class CustomException(HTTPException):
+    def get_body(self, environ=None):
+        """Get the HTML body."""
+        return _cached(_body_cache, ("html",) + self.cache_key(), lambda: self.render_body(environ))
+
+    def get_encoded_body(self, environ=None):
+        return _cached(_body_cache, ("html-utf8",) + self.cache_key(), lambda: self.get_body(environ).encode("utf-8"))
+
+    def get_json_body(self, environ=None):
+        """ compact json body, only cached when the exception carries no data """
+        data = getattr(self, "data", None)
+        body = {"code": self.code, "name": self.get_title(), "description": self.description}
+
+        if data:
+            body["data"] = data
+            return json.dumps(body, separators=(",", ":"), default=text_type)
+
+        return _cached(_body_cache, ("json",) + self.cache_key(), lambda: json.dumps(body, separators=(",", ":")))
+
+    def get_response(self, environ=None):
+        """
+        Return the response with the cached body
+        :param environ:
+        :return:
+        """
+        if self.response is not None:
+            return self.response
+
+        if self.json_response:
+            return Response(self.get_json_body(environ), self.code, [("Content-Type", "application/json")])
+
+        return Response(self.get_encoded_body(environ), self.code, self.get_headers(environ))
+
+
+class CustomException(CachedResponseMixin, HTTPException):
     def __init__(self, code, data=None, description=None, name=None):
         """
         custom model for handling HTTPExceptions
@@ -28,8 +95,11 @@ class CustomException(HTTPException):
         """Get the description."""
         return u'<p>Description: %s</p>' % escape(self.description)
 
-    def get_body(self, environ=None):
-        """Get the HTML body."""
+    def get_title(self):
+        return self.response_name
+
+    def render_body(self, environ=None):
+        """Render the HTML body."""
         return text_type((
             u'<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n'
             u'<title>%(code)s %(name)s</title>\n'
@@ -41,19 +111,8 @@ class CustomException(HTTPException):
             'description':  self.get_description()
         })
 
-    def get_response(self, environ=None):
-        """
-        Update HTTPException response processing
-        :param environ:
-        :return:
-        """
-        if self.response is not None:
-            return self.response
-        headers = self.get_headers()
-        return Response(self.get_body(environ), self.code, headers)
-
 
-class ValidationFailed(HTTPException):
+class ValidationFailed(CachedResponseMixin, HTTPException):
     """
     *34* `Validation Failed`
     Custom exception thrown when form validation fails.
@@ -81,7 +140,7 @@ class ValidationFailed(HTTPException):
     #     return resp
 
 
-class FurtherActionException(HTTPException):
+class FurtherActionException(CachedResponseMixin, HTTPException):
     """
     *34* `Further Action Exception`
     Custom exception thrown when further action is required by the user.
@@ -115,7 +174,15 @@ class FurtherActionException(HTTPException):
 # permission denied. The would occur when a user attempts to access unauthorized content
 
 
-class IntegrityException(HTTPException):
+def split_message(message):
+    """ split a database error message into its first line and the rest """
+    bits = message.split("\n")
+    if len(bits) > 1:
+        return bits[0], " ".join(bits[1:]).strip()
+    return None, " ".join(bits).strip()
+
+
+class IntegrityException(CachedResponseMixin, HTTPException):
     """
     *32* `Integrity Exception`
     Custom exception thrown when an attempt to save a resource fails.
@@ -135,12 +202,10 @@ class IntegrityException(HTTPException):
         HTTPException.__init__(self)
         self.data = e.data if hasattr(e, "data") else {}
         self.code = e.code if hasattr(e, "code") else INTEGRITY_ERROR
-        bits = e.message.split("\n")
-        if len(bits) > 1:
-            self.data["error"] = bits[0]
-            self.data["message"] = " ".join(bits[1:]).strip()
-        else:
-            self.data["message"] = " ".join(bits).strip()
+        error, message = _cached(_message_cache, e.message, lambda: split_message(e.message))
+        if error is not None:
+            self.data["error"] = error
+        self.data["message"] = message
 
     def get_response(self, environment=None):
         resp = super(IntegrityException, self).get_response(environment)
@@ -0,0 +1,179 @@
+"""
+images.py
+
+Resize uploaded images to several target sizes in one pass.
+
+Each image is opened once, checked against the expected extensions (check_extension) and,
+optionally, dimensions. JPEGs are decoded directly at a reduced scale with PIL's draft
+mode, and each size is resized from a larger result already made when there is one.
+Batches are spread across a process pool.
+
+    >>> sizes = {"large": (1200, 1200), "medium": (600, 600), "thumb": (150, 150, "crop")}
+    >>> for result in process_images(paths, "/var/media/resized", sizes, processes=8):
+    ...     if result["error"]:
+    ...         log.warning("%s: %s", result["src"], result["error"])
+
+A size is (width, height) to fit the image within the box, or (width, height, "crop") to fill
+the box and crop the overflow. Outputs are written as <dest_dir>/<name>_<size name>.<ext>.
+"""
+
+import os
+import math
+import functools
+from multiprocessing import Pool, cpu_count
+
+from PIL import Image, ImageOps
+
+import utils
+
+
+FIT = "fit"
+CROP = "crop"
+
+FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "gif": "GIF"}
+
+
+def _parse_sizes(sizes):
+    """ return [(name, width, height, mode)] from the largest to the smallest """
+    parsed = []
+
+    for name, size in sizes.items():
+        width, height = int(size[0]), int(size[1])
+        mode = size[2] if len(size) > 2 else FIT
+        if mode not in (FIT, CROP):
+            raise ValueError("Invalid resize mode for %s: %s" % (name, mode))
+        parsed.append((name, width, height, mode))
+
+    return sorted(parsed, key=lambda s: s[1] * s[2], reverse=True)
+
+
+def _prepare(img, format):
+    """ convert modes the output format cannot store """
+    if format == "JPEG" and img.mode not in ("RGB", "L"):
+        return img.convert("RGB")
+    return img
+
+
+def fit_size(size, box):
+    """ size of an image of the given size fitted within box, keeping its aspect ratio, never enlarged """
+    width, height = size
+    scale = min(float(box[0]) / width, float(box[1]) / height, 1.0)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def cover_size(size, box):
+    """ size of an image of the given size scaled to cover box, keeping its aspect ratio """
+    width, height = size
+    scale = min(max(float(box[0]) / width, float(box[1]) / height), 1.0)
+    return max(1, int(math.ceil(width * scale))), max(1, int(math.ceil(height * scale)))
+
+
+def resize_image(img, sizes):
+    """
+    resize an opened image to several sizes
+
+    :param img: PIL image, not loaded yet so draft mode can apply
+    :param sizes: list of (name, width, height, mode) from the largest to the smallest
+    :return: dict of name -> PIL image
+    """
+    original = img.size
+    targets = [(name, fit_size(original, (width, height)) if mode == FIT else (width, height), mode)
+               for name, width, height, mode in sizes]
+
+    # decode jpegs at the smallest scale that still covers every target
+    needed = [size if mode == FIT else cover_size(original, size) for name, size, mode in targets]
+    img.draft(img.mode, (max(s[0] for s in needed), max(s[1] for s in needed)))
+    img.load()
+
+    results = {}
+    fitted = []
+
+    for name, size, mode in targets:
+        if mode == CROP:
+            results[name] = ImageOps.fit(img, size, Image.ANTIALIAS)
+            continue
+
+        # resize from the smallest fit result already made that is at least as large, which has
+        # the aspect ratio of the original, otherwise from the decoded image
+        sources = [r for r in fitted if r.size[0] >= size[0] and r.size[1] >= size[1]]
+        source = min(sources, key=lambda r: r.size[0] * r.size[1]) if sources else img
+
+        results[name] = source if source.size == size else source.resize(size, Image.ANTIALIAS)
+        fitted.append(results[name])
+
+    return results
+
+
+def process_image(src, dest_dir, sizes, extensions=("jpg", "jpeg", "png", "gif"), dimensions=None,
+                  quality=85):
+    """
+    validate an image and write it in each of the sizes
+
+    :param src: image path
+    :param dest_dir: output directory
+    :param sizes: dict of name -> (width, height) or (width, height, "crop")
+    :param extensions: allowed extensions
+    :param dimensions: optional (width, height) the original must have, like check_image_size
+    :param quality: jpeg quality
+    :return: dict with src, size (original), outputs (name -> path) and error
+    """
+    result = {"src": src, "size": None, "outputs": {}, "error": None}
+
+    if not utils.check_extension(src, extensions):
+        result["error"] = "invalid extension"
+        return result
+
+    sizes = _parse_sizes(sizes) if isinstance(sizes, dict) else sizes
+    stem, ext = os.path.splitext(os.path.basename(src))
+    ext = ext[1:].lower()
+    format = FORMATS.get(ext, "PNG")
+
+    try:
+        img = Image.open(src)
+        result["size"] = img.size
+
+        if dimensions and tuple(int(d) for d in dimensions) != img.size:
+            result["error"] = "invalid dimensions"
+            return result
+
+        for name, resized in resize_image(img, sizes).items():
+            path = os.path.join(dest_dir, "%s_%s.%s" % (stem, name, ext))
+            options = {"quality": quality, "optimize": True} if format == "JPEG" else {}
+            _prepare(resized, format).save(path, format, **options)
+            result["outputs"][name] = path
+    except (IOError, ValueError, Image.DecompressionBombError) as e:
+        result["error"] = str(e)
+
+    return result
+
+
+def process_images(paths, dest_dir, sizes, processes=None, chunksize=4, **kwargs):
+    """
+    process a batch of images, yielding the results in the order of paths
+
+    :param paths: image paths
+    :param dest_dir: output directory
+    :param sizes: dict of name -> (width, height) or (width, height, "crop")
+    :param processes: worker processes, defaults to the number of cpus. 1 runs in this process
+    :param chunksize: images per task
+    :param kwargs: passed to process_image (extensions, dimensions, quality)
+    """
+    worker = functools.partial(process_image, dest_dir=dest_dir, sizes=_parse_sizes(sizes), **kwargs)
+    processes = processes or cpu_count()
+
+    if processes == 1:
+        for path in paths:
+            yield worker(path)
+        return
+
+    pool = Pool(processes)
+
+    try:
+        for result in pool.imap(worker, paths, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
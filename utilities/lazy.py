@@ -0,0 +1,54 @@
+"""
+lazy.py
+
+Deferred imports for the heavy third party dependencies used by utilities.utils
+
+    >>> PImage = LazyImport("PIL.Image", namespace=globals(), name="PImage")
+
+The module is only imported the first time an attribute of PImage is used or it is called.
+When a namespace is given, the name is then rebound to the real object so later uses
+do not go through the proxy.
+"""
+
+import importlib
+
+
+class LazyImport(object):
+    """ stands in for a module (or an attribute of a module) and imports it on first use """
+
+    def __init__(self, module_name, attr=None, namespace=None, name=None):
+        """
+        :param module_name: dotted name of the module to import
+        :param attr: optional attribute of the module to resolve e.g. a class
+        :param namespace: optional dict (module globals) in which to rebind name once loaded
+        :param name: name to rebind in namespace
+        """
+        self.__dict__.update(_module_name=module_name, _attr=attr, _namespace=namespace, _name=name, _target=None)
+
+    def _load(self):
+        target = self.__dict__["_target"]
+
+        if target is None:
+            target = importlib.import_module(self._module_name)
+            if self._attr:
+                target = getattr(target, self._attr)
+
+            self.__dict__["_target"] = target
+            if self._namespace is not None and self._namespace.get(self._name) is self:
+                self._namespace[self._name] = target
+
+        return target
+
+    def is_loaded(self):
+        return self.__dict__["_target"] is not None
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        if self._attr:
+            return "<lazy %s.%s>" % (self._module_name, self._attr)
+        return "<lazy %s>" % self._module_name
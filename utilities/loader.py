@@ -7,13 +7,133 @@ Load objects from an external json document and populate an object or objects wi
 
 """
 
+import io
+import re
 import json
+import time
+import hashlib
 import utils
 import os
-
-
-def get_or_create(db, model, **kwargs):
-    """ attempt to fetch an object that matches the parameters first or create it if not found"""
+from utils import chunks
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+
+from datetime import datetime, date
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import or_, and_, types
+from sqlalchemy.orm import class_mapper
+
+
+logger = getLogger(__name__)
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DELIMITERS = frozenset(u" \t\n\r,]}:")
+
+
+class FixtureReader(object):
+    """
+    Incremental reader for the top level object of a json fixture. The `objects` array is
+    yielded as a generator of its entries so only one entry is held in memory at a time
+    """
+
+    def __init__(self, f, stream_key="objects", chunk_size=64 * 1024):
+        self.f = f
+        self.stream_key = stream_key
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = u""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        """ read the next chunk into the buffer, discarding what has been consumed """
+        if self.eof:
+            return False
+
+        if self.pos > self.chunk_size:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+
+        data = self.f.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buf += data
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char is None or char not in chars:
+            raise ValueError("Invalid fixture: expected one of %r but found %r" % (chars, char))
+        self.pos += 1
+        return char
+
+    def _value(self):
+        """ decode the next json value, reading more data until it is complete """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number cut at the end of the chunk (e.g. "12." of "12.5") may continue in the
+                # next one, it is only complete once a delimiter follows it
+                number = isinstance(value, (int, long, float)) and not isinstance(value, bool)
+                if self.eof or (end < len(self.buf) and (not number or self.buf[end] in DELIMITERS)):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill(max(self.chunk_size, len(self.buf) - self.pos))
+
+    def _array(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def items(self):
+        """ yield the (key, value) pairs of the top level object in file order """
+        self._expect("{")
+        if self._peek() == "}":
+            return
+
+        while True:
+            key = self._value()
+            self._expect(":")
+
+            if key == self.stream_key and self._peek() == "[":
+                entries = self._array()
+                yield key, entries
+                # skip whatever the consumer did not read
+                for _ in entries:
+                    pass
+            else:
+                yield key, self._value()
+
+            if self._expect(",}") == "}":
+                return
+
+
+def get_or_create(db, model, commit=True, **kwargs):
+    """
+    attempt to fetch an object that matches the parameters first or create it if not found.
+    with commit=False the new object is only flushed and the caller commits
+    """
     instance = model.query.filter_by(**kwargs).first()
 
     if instance:
@@ -23,66 +143,516 @@ def get_or_create(db, model, **kwargs):
         try:
 
             db.session.add(instance)
-            db.session.commit()
+            if commit:
+                db.session.commit()
+            else:
+                db.session.flush()
             return instance, True
         except:
             db.session.rollback()
             raise
 
 
+DATETIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S",
+                    "%Y-%m-%d")
+
+
+def _parse_datetime(value):
+    for format in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    return value
+
+
+def _normalizer(column_type):
+    """ return a function converting fixture values to the python type the column returns """
+    if isinstance(column_type, types.Numeric) and column_type.asdecimal:
+        def normalize(value):
+            if isinstance(value, float):
+                return Decimal(repr(value))
+            return Decimal(value) if isinstance(value, (int, long, basestring)) else value
+    elif isinstance(column_type, types.Float):
+        def normalize(value):
+            return float(value) if isinstance(value, (int, long, basestring, Decimal)) else value
+    elif isinstance(column_type, types.Integer):
+        def normalize(value):
+            return int(value) if isinstance(value, basestring) else value
+    elif isinstance(column_type, types.Boolean):
+        def normalize(value):
+            return bool(value) if isinstance(value, (int, long)) else value
+    elif isinstance(column_type, types.DateTime):
+        def normalize(value):
+            if isinstance(value, basestring):
+                return _parse_datetime(value)
+            return value if isinstance(value, datetime) or not isinstance(value, date) else datetime.combine(
+                value, datetime.min.time())
+    elif isinstance(column_type, types.Date):
+        def normalize(value):
+            if isinstance(value, basestring):
+                value = _parse_datetime(value)
+            return value.date() if isinstance(value, datetime) else value
+    elif isinstance(column_type, types.String):
+        def normalize(value):
+            return value.decode("utf-8") if isinstance(value, str) else value
+    else:
+        return None
+
+    def _normalize(value):
+        if value is None:
+            return None
+        try:
+            return normalize(value)
+        except (ValueError, TypeError, InvalidOperation, UnicodeDecodeError):
+            return value
+
+    return _normalize
+
+
+def key_normalizer(model, key_fields):
+    """
+    return a function mapping a tuple of key values to the types the columns return, so fixture
+    values (floats, date strings...) compare equal to the values loaded from the database
+    """
+    mapper = class_mapper(model)
+    normalizers = []
+
+    for field in key_fields:
+        prop = mapper.get_property(field) if mapper.has_property(field) else None
+        columns = getattr(prop, "columns", None)
+        normalizers.append(_normalizer(columns[0].type) if columns else None)
+
+    if not any(normalizers):
+        return tuple
+
+    def normalize(key):
+        return tuple(f(v) if f else v for f, v in zip(normalizers, key))
+
+    return normalize
+
+
+def _key_criteria(model, key_fields, keys):
+    """ build the where clause matching any of the natural keys """
+    if len(key_fields) == 1:
+        column = getattr(model, key_fields[0])
+        values = [k[0] for k in keys if k[0] is not None]
+        criteria = [column.in_(values)] if values else []
+        if len(values) < len(keys):
+            criteria.append(column.is_(None))
+        return or_(*criteria)
+
+    return or_(*[and_(*[getattr(model, f) == v for f, v in zip(key_fields, k)]) for k in keys])
+
+
+def _prefetch(model, key_fields, keys, chunk_size, normalize=tuple):
+    """ fetch the existing objects matching the natural keys, indexed by normalized key """
+    index = {}
+    per_query = max(1, chunk_size // len(key_fields))
+
+    for batch in chunks(keys, per_query):
+        for instance in model.query.filter(_key_criteria(model, key_fields, batch)):
+            index.setdefault(normalize(tuple(getattr(instance, f) for f in key_fields)), instance)
+
+    return index
+
+
+def get_or_create_many(db, model, rows, key_fields, commit=True, chunk_size=500, update=False, bulk=False):
+    """
+    Batched get_or_create. Existing objects are prefetched by their natural key in chunked queries,
+    the missing rows are created and the objects are returned in the order of rows
+
+    :param rows: list of object data (dicts)
+    :param key_fields: names of the fields that identify an object. values are converted to the
+        type of their column (e.g. Decimal for Numeric, date for Date) before they are compared
+    :param commit: commit the inserted rows, otherwise they are only flushed
+    :param chunk_size: maximum number of key values bound per query
+    :param update: apply the row data to the existing objects that were found
+    :param bulk: insert the rows that only set columns with bulk_insert_mappings. this is faster but
+        skips the model __init__, @validates and the mapper events for those rows
+    :return: list of (instance, created) tuples
+    """
+    key_fields = tuple(key_fields)
+    normalize = key_normalizer(model, key_fields)
+    keys = [normalize(tuple(row.get(f) for f in key_fields)) for row in rows]
+    index = _prefetch(model, key_fields, list(set(keys)), chunk_size, normalize)
+
+    columns = set(p.key for p in class_mapper(model).column_attrs)
+    missing = {}
+    mappings = []
+    created = set()
+
+    for key, row in zip(keys, rows):
+        if key in index:
+            if update:
+                utils.populate_obj(index[key], row)
+            continue
+
+        if key in missing:
+            continue
+        missing[key] = row
+
+        if bulk and set(row.keys()) <= columns:
+            mappings.append(row)
+        else:
+            # rows setting relationships or properties go through the session
+            instance = utils.populate_obj(model(), row)
+            db.session.add(instance)
+            index[key] = instance
+            created.add(key)
+
+    try:
+        if mappings:
+            db.session.bulk_insert_mappings(model, mappings)
+        db.session.flush()
+    except:
+        db.session.rollback()
+        raise
+
+    if mappings:
+        inserted = [key for key in missing if key not in index]
+        index.update(_prefetch(model, key_fields, inserted, chunk_size, normalize))
+        created.update(inserted)
+
+        for key in inserted:
+            # the database returned the key in another type e.g. a date for a string
+            if key not in index:
+                index[key] = model.query.filter_by(**dict(zip(key_fields, key))).first()
+
+    if commit:
+        try:
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+    return [(index[key], key in created) for key in keys]
+
+
+def _existing_slugs(model, field, bases, delim, chunk_size):
+    """ fetch the existing slugs equal to one of the bases or starting with base + delim """
+    column = getattr(model, field)
+    existing = set()
+
+    for batch in chunks(bases, chunk_size):
+        criteria = []
+        for base in batch:
+            prefix = base.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + delim
+            criteria.append(or_(column == base, column.like(prefix + "%", escape="\\")))
+
+        existing.update(slug for (slug,) in model.query.with_entities(column).filter(or_(*criteria)))
+
+    return existing
+
+
+def allocate_slugs(model, field, texts, delim=u"-", chunk_size=50):
+    """
+    slugify texts and make the slugs unique against the existing values of field and each other.
+    a taken slug gets the lowest free numeric suffix e.g. red-shoes-2
+
+    :param model: model class
+    :param field: name of the slug column
+    :param texts: texts to slugify
+    :param chunk_size: base slugs looked up per query
+    :return: list of slugs in the order of texts
+    """
+    bases = [utils.slugify(text, delim) for text in texts]
+    # every candidate is a base or base + delim + number, so the prefix queries cover all the
+    # existing slugs a candidate can collide with. slugs assigned in the batch are added as they
+    # go, which also catches a base equal to the suffixed slug of another e.g. "product-1"
+    taken = _existing_slugs(model, field, list(set(bases)), delim, chunk_size)
+    cursors = {}
+    slugs = []
+
+    for base in bases:
+        slug = base
+        number = cursors.get(base, 0)
+
+        while slug in taken:
+            number += 1
+            slug = "%s%s%d" % (base, delim, number)
+
+        taken.add(slug)
+        cursors[base] = number
+        slugs.append(slug)
+
+    return slugs
+
+
+def unique_slugs(model, field, texts, save=None, retries=3, delim=u"-", chunk_size=50):
+    """
+    allocate unique slugs for a batch of texts with one query per chunk of base slugs.
+    when save is given it is called with the slugs to write them. if a concurrent writer took one
+    of them first (IntegrityError), the slugs are allocated again and save is retried
+
+    :param model: model class
+    :param field: name of the slug column, it should have a unique constraint
+    :param texts: texts to slugify
+    :param save: optional callable taking the list of slugs, which inserts and commits the rows
+    :param retries: attempts after a conflict before the error is raised
+    :return: list of slugs in the order of texts
+    """
+    from sqlalchemy.exc import IntegrityError
+
+    attempt = 0
+
+    while True:
+        slugs = allocate_slugs(model, field, texts, delim, chunk_size)
+        if save is None:
+            return slugs
+
+        try:
+            save(slugs)
+            return slugs
+        except IntegrityError:
+            model.query.session.rollback()
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.info("Slug conflict on %s.%s, retrying (%d)", model.__name__, field, attempt)
+
+
 def load_class(module, class_name):
     """ Loads the class from a module by the class name"""
     klass = getattr(module, class_name, None)
     return klass
 
 
+def attach_children(db, module, parents, classes=None, update=False, bulk=False):
+    """
+    Attach the children of a batch of parents. Children are grouped by model across all the parents,
+    their parent foreign keys are set directly instead of appending through the relationship (which
+    would lazy load the existing collection) and each group is resolved with get_or_create_many.
+    Nothing is committed, the caller commits the batch
+
+    :param parents: list of (parent object, children declarations)
+    :param classes: cache of classes already resolved by name
+    :param update: apply the fixture data to children that already exist
+    :param bulk: insert with bulk_insert_mappings, see get_or_create_many
+    :return: number of children attached
+    """
+    classes = {} if classes is None else classes
+    groups = {}
+
+    for obj, children in parents:
+        for _data in children:
+            class_name = _data.get("model", None)
+            property_name = _data.get("property", None)
+            objects = _data.get("objects", None)
+            parent = _data.get("parent", None)
+
+            if class_name not in classes:
+                classes[class_name] = load_class(module, class_name)
+            klass = classes[class_name]
+
+            if klass and parent and property_name and objects:
+                for _d in objects:
+                    _d[parent] = obj.id
+                groups.setdefault(klass, []).extend(objects)
+
+    count = 0
+    for klass, rows in groups.items():
+        for key_fields, _rows in group_by_fields(rows, primary_key=primary_key_fields(klass)):
+            get_or_create_many(db, klass, _rows, key_fields, commit=False, update=update, bulk=bulk)
+            count += len(_rows)
+
+    return count
+
+
 def append_children(db, module, obj, children=[]):
     """ Append the children to a parent object """
 
-    for _data in children:
-        class_name = _data.get("model", None)
-        property_name = _data.get("property", None)
-        objects = _data.get("objects", None)
-        parent = _data.get("parent", None)
-        klass = load_class(module, class_name)
+    try:
+        attach_children(db, module, [(obj, children)])
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+
+def primary_key_fields(model):
+    """ names of the attributes mapped to the primary key of a model """
+    mapper = class_mapper(model)
+    return tuple(mapper.get_property_by_column(c).key for c in mapper.primary_key)
+
+
+def group_by_fields(rows, key_fields=None, primary_key=None):
+    """
+    group rows for get_or_create_many. without key_fields, rows containing the primary key are
+    matched on it and other rows are matched on all their fields like get_or_create, so rows with
+    the same set of fields are grouped together
+    """
+    if key_fields:
+        return [(tuple(key_fields), list(rows))]
+
+    groups = {}
+    for row in rows:
+        fields = tuple(sorted(row.keys()))
+        if primary_key and set(primary_key) <= set(fields):
+            fields = primary_key
+        groups.setdefault(fields, []).append(row)
+
+    return groups.items()
+
+
+def load_objects(db, module, klass, objects, batch_size=500, progress=None, key_fields=None, update=False,
+                 bulk=False):
+    """
+    Create the objects (and their children) in batches, committing once per batch
+
+    :param objects: iterable of object data
+    :param batch_size: number of objects per transaction
+    :param progress: optional callback receiving (rows loaded, rows per second) after each batch
+    :param key_fields: fields identifying an existing object, defaults to the primary key when
+        the object has one and to all the fields of the object otherwise
+    :param update: apply the fixture data to objects that already exist. a modified object can only
+        be matched to its row by its primary key or key_fields, so objects without a primary key
+        require key_fields (ValueError otherwise)
+    :param bulk: insert with bulk_insert_mappings, skipping the model __init__, validators and
+        mapper events (see get_or_create_many)
+    :return: number of objects loaded
+    """
+    start = time.time()
+    count = 0
+    classes = {}
+    primary_key = primary_key_fields(klass)
+
+    for batch in chunks(objects, batch_size):
+        if update and not key_fields and any(not set(primary_key) <= set(_data) for _data in batch):
+            raise ValueError("%s: objects without a primary key need key_fields to be updated" % klass.__name__)
 
-        if klass and parent and property_name and objects:
-            for _d in objects:
-                _d[parent] = obj.id
-                child, status = get_or_create(db, klass, **_d)
-                getattr(obj, property_name).append(child)
+        try:
+            # extract the children first then create the parents and append the children next
+            children = [_data.pop("children", []) for _data in batch]
+            instances = {}
 
-        db.session.commit()
+            for _key_fields, rows in group_by_fields(batch, key_fields, primary_key):
+                results = get_or_create_many(db, klass, rows, _key_fields, commit=False, update=update, bulk=bulk)
+                for row, (obj, status) in zip(rows, results):
+                    instances[id(row)] = obj
 
+            parents = [instances[id(_data)] for _data in batch]
+            attach_children(db, module, zip(parents, children), classes, update, bulk)
 
-def load_data(module, db, filepath):
-    """ Loads up a json file and converts the data inside to python objects """
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
 
-    f = open(filepath)
+        count += len(batch)
+        rate = count / max(time.time() - start, 1e-6)
+        logger.info("%s: %d rows loaded (%.1f rows/s)", klass.__name__, count, rate)
 
-    data = json.loads(f.read().encode("UTF-8"))
+        if progress:
+            progress(count, rate)
 
-    # extract the information required
-    class_name = data.get("model", None)
-    objects = data.get("objects", [])
+    return count
 
-    klass = load_class(module, class_name)
 
-    if klass:
-        for _data in objects:
-            # extract the children first then create the parent and append the children next
-            children = _data.pop("children", [])
-            obj, status = get_or_create(db, klass, **_data)
-            append_children(db, module, obj, children)
-            # print "Done"
+def _load_data(module, db, filepath, stream, batch_size, progress, key_fields, entry, bulk=False):
+    """ load a fixture, passing the objects through the manifest entry when there is one """
+
+    def _objects(objects):
+        return entry.changed(objects) if entry else objects
+
+    with io.open(filepath, encoding="utf-8") as f:
+        if not stream:
+            data = json.load(f)
+            klass = load_class(module, data.get("model", None))
+
+            if klass:
+                return load_objects(db, module, klass, _objects(data.get("objects", [])), batch_size, progress,
+                                    key_fields, update=entry is not None, bulk=bulk)
+            return 0
+
+        klass = None
+        deferred = False
+
+        for key, value in FixtureReader(f).items():
+            if key == "model":
+                klass = load_class(module, value)
+            elif key == "objects":
+                if klass:
+                    return load_objects(db, module, klass, _objects(value), batch_size, progress, key_fields,
+                                        update=entry is not None, bulk=bulk)
+                # the model is declared after the objects, read them again once it is known
+                deferred = True
+
+    if deferred and klass:
+        with io.open(filepath, encoding="utf-8") as f:
+            for key, value in FixtureReader(f).items():
+                if key == "objects":
+                    return load_objects(db, module, klass, _objects(value), batch_size, progress, key_fields,
+                                        update=entry is not None, bulk=bulk)
+
+    return 0
+
+
+def load_data(module, db, filepath, stream=False, batch_size=500, progress=None, key_fields=None, manifest=None,
+              bulk=False):
+    """
+    Loads up a json file and converts the data inside to python objects.
+    With stream=True the `objects` entries are parsed one at a time so memory
+    stays bounded regardless of the size of the file. With a manifest, unchanged
+    files are skipped and only added or modified objects are loaded, matched to their rows by
+    primary key or key_fields (required when the objects have no primary key). bulk=True inserts
+    new rows with bulk_insert_mappings, which skips the model __init__, validators and
+    mapper events
+    """
+    if manifest is None:
+        return _load_data(module, db, filepath, stream, batch_size, progress, key_fields, None, bulk)
+
+    entry = manifest.begin(filepath)
+    if entry is None:
+        logger.info("%s: unchanged, skipped", filepath)
+        return 0
+
+    count = _load_data(module, db, filepath, stream, batch_size, progress, key_fields, entry, bulk)
+    manifest.commit(entry)
 
+    return count
 
-def load_via_filepath(module, db, filepath, template_base_dir, extra_data={}):
-    """ Loads up a json file and updates the data inside based on the content of the file """
 
-    _file = open(filepath)
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
 
-    data = json.loads(_file.read().encode("UTF-8"))
+
+def read_files(paths, workers=8, cache=None):
+    """
+    Read files concurrently with a bounded thread pool. Each distinct file is read once,
+    files already in the cache are not read again and missing files are left out
+
+    :param paths: file paths
+    :param workers: maximum number of files read at the same time
+    :param cache: dict of path -> content shared between calls (e.g. for a whole load_directory run)
+    :return: dict of path -> content
+    """
+    cache = {} if cache is None else cache
+    pending = [path for path in set(paths) if path not in cache and os.path.isfile(path)]
+
+    if pending:
+        pool = ThreadPool(min(workers, len(pending)))
+        try:
+            cache.update(zip(pending, pool.map(_read_file, pending)))
+        finally:
+            pool.close()
+            pool.join()
+
+    return cache
+
+
+def load_via_filepath(module, db, filepath, template_base_dir, extra_data={}, manifest=None, file_cache=None,
+                      workers=8):
+    """
+    Loads up a json file and updates the data inside based on the content of the file.
+    The referenced files are collected first and read concurrently, once each.
+    With a manifest, the file is skipped when neither it nor the files it references have
+    changed, and only added or modified elements are loaded (and returned)
+    """
+
+    with io.open(filepath, encoding="utf-8") as _file:
+        data = json.load(_file)
 
     objects = data.get("objects")
     class_name = data.get("model")
@@ -91,23 +661,188 @@ def load_via_filepath(module, db, filepath, template_base_dir, extra_data={}):
     klass = load_class(module, class_name)
 
     model_objects = []
+    entry = None
+
+    paths = set(os.path.join(base_path, value) for element in objects
+                for value in element.get("file_path", {}).values())
+    contents = read_files(paths, workers, file_cache)
+
+    if manifest is not None:
+        assets = dict((path, hashlib.sha1(contents[path]).hexdigest()) for path in paths if path in contents)
+        entry = manifest.begin(filepath, assets)
+
+        if entry is None:
+            logger.info("%s: unchanged, skipped", filepath)
+            return model_objects
+
+        extra = [json.dumps(extra_data, sort_keys=True)]
+        objects = entry.changed(objects, lambda element: extra + [
+            assets.get(os.path.join(base_path, value), "") for key, value in sorted(element.get("file_path", {}).items())])
 
     if klass:
+        elements = []
+        children = []
+        template_fields = set()
+
         for element in objects:
             file_path = element.pop('file_path')
+            template_fields.update(file_path.keys())
 
             for key, value in file_path.items():
 
                 key_addr = os.path.join(base_path, value)
                 # check if file exists
-                if os.path.isfile(key_addr):
-                    key_file = open(key_addr)
-                    element[key] = key_file.read().encode('UTF-8')
+                if key_addr in contents:
+                    element[key] = contents[key_addr].decode("utf-8")
                     element.update(extra_data)
-            # extract the children first then create the parent and append the children next
-            children = element.pop("children", [])
-            obj, status = get_or_create(db, klass, **element)
-            model_objects.append(obj)
-            append_children(db, module, obj, children)
+            # extract the children first then create the parents and append the children next
+            children.append(element.pop("children", []))
+            elements.append(element)
+
+        # like load_data, elements carrying the primary key are matched on it. the others are matched
+        # on their own fields without the template contents, so a modified template updates its row
+        # instead of inserting a copy
+        primary_key = primary_key_fields(klass)
+        groups = {}
+        for element in elements:
+            if set(primary_key) <= set(element):
+                fields = primary_key
+            else:
+                fields = tuple(sorted(k for k in element if k not in template_fields)) or tuple(sorted(element))
+            groups.setdefault(fields, []).append(element)
+
+        try:
+            instances = {}
+            for key_fields, rows in groups.items():
+                results = get_or_create_many(db, klass, rows, key_fields, commit=False, update=entry is not None)
+                for row, (obj, status) in zip(rows, results):
+                    instances[id(row)] = obj
+
+            model_objects = [instances[id(element)] for element in elements]
+            attach_children(db, module, zip(model_objects, children), update=entry is not None)
+
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
 
-    return model_objects
\ No newline at end of file
+    if entry is not None:
+        manifest.commit(entry)
+
+    return model_objects
+
+
+def read_declarations(filepath):
+    """
+    Read the model, child models and base path declared in a fixture without loading its objects
+    :return: (model name, set of child model names, base path)
+    """
+    model = None
+    base_path = None
+    children = set()
+
+    with io.open(filepath, encoding="utf-8") as f:
+        for key, value in FixtureReader(f).items():
+            if key == "model":
+                model = value
+            elif key == "base_path":
+                base_path = value
+            elif key == "objects":
+                for _data in value:
+                    if isinstance(_data, dict):
+                        children.update(c.get("model") for c in _data.get("children", []) if c.get("model"))
+
+    return model, children, base_path
+
+
+def _tables(klass):
+    return set(class_mapper(klass).tables) if klass else set()
+
+
+def dependency_levels(module, declarations):
+    """
+    Order fixtures into levels that can be loaded concurrently. A fixture depends on the fixtures
+    providing the tables its models (and child models) reference through foreign keys, and fixtures
+    writing to the same table are loaded one after the other in file name order
+
+    :param declarations: dict of filepath -> (model name, child model names, base path)
+    :return: list of levels (lists of filepaths)
+    """
+    provides = {}
+    requires = {}
+
+    for filepath, (model, children, base_path) in declarations.items():
+        tables = set()
+        for class_name in [model] + list(children):
+            tables |= _tables(load_class(module, class_name))
+
+        provides[filepath] = tables
+        requires[filepath] = set(fk.column.table for t in tables for fk in t.foreign_keys) - tables
+
+    files = sorted(declarations)
+    depends = {}
+
+    for i, filepath in enumerate(files):
+        depends[filepath] = set(other for j, other in enumerate(files) if other != filepath and (
+            provides[other] & requires[filepath] or (j < i and provides[other] & provides[filepath])))
+
+    levels = []
+    done = set()
+
+    while len(done) < len(files):
+        level = [f for f in files if f not in done and depends[f] <= done]
+        if not level:
+            raise ValueError("Circular fixture dependencies between: %s" % ", ".join(f for f in files if f not in done))
+        levels.append(level)
+        done.update(level)
+
+    return levels
+
+
+def load_directory(module, db, path, workers=4, template_base_dir=None, extra_data=None, batch_size=500,
+                   manifest=None, bulk=False, key_fields=None):
+    """
+    Load every json fixture in a directory. Fixtures are ordered by their model dependencies
+    and each level is loaded concurrently, one session per worker thread. Fixtures declaring a
+    `base_path` are loaded with load_via_filepath when template_base_dir is given. The manifest,
+    when given, is saved once the directory has been loaded (or a level failed)
+
+    :param workers: number of fixtures loaded at the same time
+    :param bulk: insert the fixture rows with bulk_insert_mappings, see load_data
+    :param key_fields: dict of model name -> fields identifying its objects, needed with a manifest
+        for models whose fixtures carry no primary key
+    :return: dict of filepath -> number of objects loaded
+    """
+    files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json"))
+    app = db.get_app()
+    pool = ThreadPool(max(1, workers))
+    file_cache = {}
+    results = {}
+
+    def _load(filepath):
+        model, children, base_path = declarations[filepath]
+        with app.app_context():
+            try:
+                if base_path is not None and template_base_dir:
+                    return len(load_via_filepath(module, db, filepath, template_base_dir, extra_data or {}, manifest,
+                                                 file_cache))
+                return load_data(module, db, filepath, stream=True, batch_size=batch_size, manifest=manifest,
+                                 bulk=bulk, key_fields=(key_fields or {}).get(model))
+            finally:
+                db.session.remove()
+
+    try:
+        declarations = dict(zip(files, pool.map(read_declarations, files)))
+
+        for level in dependency_levels(module, declarations):
+            # each level is a barrier, map returns once every fixture in it is loaded
+            results.update(zip(level, pool.map(_load, level)))
+            logger.info("Loaded fixtures: %s", ", ".join(os.path.basename(f) for f in level))
+    finally:
+        pool.close()
+        pool.join()
+
+        if manifest is not None:
+            manifest.save()
+
+    return results
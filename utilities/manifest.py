@@ -0,0 +1,122 @@
+"""
+manifest.py
+
+Content hashes of loaded fixtures, used by the loader to skip fixtures that have not
+changed since the last run and to apply only the objects that were added or modified
+
+    >>> manifest = Manifest("/var/lib/app/fixtures.manifest.json")
+    >>> load_data(models, db, "fixtures/categories.json", manifest=manifest)
+    >>> manifest.save()
+
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """ sha1 of the content of a file, read in chunks """
+    digest = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def hash_object(data, *extra):
+    """ sha1 of the canonical json of a fixture object and any extra values it depends on """
+    digest = hashlib.sha1(json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+
+    for value in extra:
+        digest.update(value.encode("utf-8"))
+
+    return digest.hexdigest()[:20]
+
+
+class ManifestEntry(object):
+    """ the state of one fixture while it is being loaded """
+
+    def __init__(self, key, file_hash, assets, seen):
+        self.key = key
+        self.file_hash = file_hash
+        self.assets = assets
+        self.seen = seen
+        self.hashes = set()
+
+    def changed(self, objects, extra=None):
+        """
+        yield only the objects that were added or modified since the last run
+
+        :param objects: iterable of fixture objects
+        :param extra: optional function returning extra values (e.g. asset hashes) an object depends on
+        """
+        for data in objects:
+            digest = hash_object(data, *(extra(data) if extra else ()))
+            self.hashes.add(digest)
+
+            if digest not in self.seen:
+                yield data
+
+
+class Manifest(object):
+    """ json file mapping each fixture to its content hash, its assets' hashes and its objects' hashes """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.base_dir = os.path.dirname(self.path)
+        self.lock = threading.Lock()
+        self.files = {}
+
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.files = json.load(f).get("files", {})
+
+    def key(self, filepath):
+        """ paths are stored relative to the manifest so it survives moving the deploy directory """
+        return os.path.relpath(os.path.abspath(filepath), self.base_dir)
+
+    def begin(self, filepath, assets=None):
+        """
+        start loading a fixture
+
+        :param filepath: fixture path
+        :param assets: dict of referenced asset path -> content hash
+        :return: ManifestEntry, or None when the fixture and its assets are unchanged
+        """
+        key = self.key(filepath)
+        file_hash = hash_file(filepath)
+        assets = dict((self.key(p), h) for p, h in (assets or {}).items())
+
+        with self.lock:
+            previous = self.files.get(key, {})
+
+        if previous.get("hash") == file_hash and previous.get("assets", {}) == assets:
+            return None
+
+        return ManifestEntry(key, file_hash, assets, set(previous.get("objects", [])))
+
+    def commit(self, entry):
+        """ record a fixture as loaded """
+        with self.lock:
+            self.files[entry.key] = {
+                "hash": entry.file_hash,
+                "assets": entry.assets,
+                "objects": sorted(entry.hashes)
+            }
+
+    def save(self):
+        """ write the manifest atomically """
+        with self.lock:
+            data = json.dumps({"files": self.files}, sort_keys=True)
+
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.rename(tmp_path, self.path)
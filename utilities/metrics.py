@@ -0,0 +1,286 @@
+"""
+metrics.py
+
+Buffered metrics emitter for InfluxDB.
+
+Counters, gauges and timers are recorded as line protocol points in a bounded
+in-memory buffer and written in batches by a background thread, either when the
+buffer reaches `batch_size` points or every `flush_interval` seconds.
+
+    >>> from utilities.metrics import MetricsEmitter, InfluxDBSink
+    >>> metrics = MetricsEmitter(InfluxDBSink(database="stats"), tags={"host": "web-1"})
+    >>> metrics.start()
+    >>> metrics.counter("page.views", tags={"page": "home"})
+    >>> with metrics.timed("db.query"):
+    ...     run_query()
+
+"""
+
+import time
+import threading
+import atexit
+from collections import deque
+from logging import getLogger
+
+import requests
+
+
+logger = getLogger(__name__)
+
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+
+
+def _bytes(value):
+    """ utf-8 encoded str of a value, str() fails on non-ascii unicode """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def _escape_key(value):
+    """ escape measurement names, tag keys and tag values for the line protocol """
+    return _bytes(value).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _format_field(value):
+    """ format a field value for the line protocol """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+
+    if isinstance(value, (int, long)):
+        return "%di" % value
+
+    if isinstance(value, float):
+        return repr(value)
+
+    return '"%s"' % _bytes(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def make_line(measurement, fields, tags=None, timestamp=None):
+    """
+    build a single line protocol point
+
+    :param measurement: measurement name
+    :param fields: field values (dict)
+    :param tags: tag values (dict)
+    :param timestamp: timestamp in nanoseconds, defaults to now
+    :return: line protocol string
+    """
+    if timestamp is None:
+        timestamp = int(time.time() * 1e9)
+
+    key = _escape_key(measurement)
+
+    if tags:
+        key += "".join(",%s=%s" % (_escape_key(k), _escape_key(v)) for k, v in sorted(tags.items()) if v is not None)
+
+    field_set = ",".join("%s=%s" % (_escape_key(k), _format_field(v)) for k, v in sorted(fields.items()))
+
+    return "%s %s %d" % (key, field_set, timestamp)
+
+
+class InfluxDBSink(object):
+    """ writes batches of points to InfluxDB using the influxdb client """
+
+    def __init__(self, client=None, **kwargs):
+        """
+        :param client: an existing InfluxDBClient instance
+        :param kwargs: arguments used to create a client when none is passed
+        """
+        if client is None:
+            from influxdb import InfluxDBClient
+            client = InfluxDBClient(**kwargs)
+
+        self.client = client
+
+    def write(self, lines):
+        self.client.write_points(lines, time_precision="n", protocol="line")
+
+
+class FileSink(object):
+    """ appends batches of points to a file, one point per line """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, lines):
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+
+
+class HTTPSink(object):
+    """ posts batches of points to an InfluxDB compatible `/write` endpoint """
+
+    def __init__(self, url, params=None, timeout=5, auth=None):
+        """
+        :param url: write endpoint e.g. http://localhost:8086/write
+        :param params: query parameters e.g. {"db": "stats", "precision": "n"}
+        :param timeout: request timeout in seconds
+        :param auth: optional (username, password)
+        """
+        self.url = url
+        self.params = params or {}
+        self.timeout = timeout
+        self.session = requests.Session()
+        if auth:
+            self.session.auth = auth
+
+    def write(self, lines):
+        resp = self.session.post(self.url, params=self.params, data="\n".join(lines) + "\n", timeout=self.timeout)
+        resp.raise_for_status()
+
+
+class _Timer(object):
+    """ context manager that records the elapsed time of its block in milliseconds """
+
+    def __init__(self, emitter, name, tags):
+        self.emitter = emitter
+        self.name = name
+        self.tags = tags
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.emitter.timer(self.name, (time.time() - self.start) * 1000.0, tags=self.tags)
+        return False
+
+
+class MetricsEmitter(object):
+    """ buffers metric points in memory and flushes them to a sink in batches """
+
+    def __init__(self, sink, batch_size=5000, flush_interval=10.0, max_buffer=100000, drop_policy=DROP_OLDEST,
+                 tags=None, prefix=None):
+        """
+        :param sink: object with a `write(lines)` method
+        :param batch_size: number of buffered points that triggers a flush
+        :param flush_interval: seconds between time triggered flushes
+        :param max_buffer: maximum number of points held in memory
+        :param drop_policy: DROP_OLDEST or DROP_NEWEST, applied when the buffer is full
+        :param tags: default tags added to every point
+        :param prefix: prefix added to every measurement name
+        """
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Invalid drop policy: %s" % drop_policy)
+
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.drop_policy = drop_policy
+        self.tags = tags or {}
+        self.prefix = prefix
+        self.dropped = 0
+
+        self._buffer = deque()
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """ start the background flush thread """
+        if self._running:
+            return self
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="metrics-flusher")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+        return self
+
+    def stop(self, timeout=None):
+        """ stop the background thread and flush whatever is still buffered """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+        self.flush()
+
+    def record(self, measurement, fields, tags=None, timestamp=None):
+        """ add a point to the buffer, applying the drop policy when the buffer is full """
+        if self.prefix:
+            measurement = "%s.%s" % (self.prefix, measurement)
+
+        _tags = dict(self.tags, **tags) if tags else self.tags
+        line = make_line(measurement, fields, _tags, timestamp)
+
+        with self._condition:
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                if self.drop_policy == DROP_NEWEST:
+                    return
+                self._buffer.popleft()
+
+            self._buffer.append(line)
+
+            if len(self._buffer) >= self.batch_size:
+                self._condition.notify()
+
+    def counter(self, name, value=1, tags=None):
+        self.record(name, {"count": int(value)}, tags)
+
+    def gauge(self, name, value, tags=None):
+        self.record(name, {"value": float(value)}, tags)
+
+    def timer(self, name, value, tags=None):
+        """ record a duration in milliseconds """
+        self.record(name, {"duration": float(value)}, tags)
+
+    def timed(self, name, tags=None):
+        """ context manager that records the duration of its block with `timer` """
+        return _Timer(self, name, tags)
+
+    def pending(self):
+        """ number of points currently buffered """
+        return len(self._buffer)
+
+    def _drain(self):
+        with self._condition:
+            count = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(count)]
+
+    def flush(self):
+        """
+        write all buffered points to the sink in batches of `batch_size`
+        :return: number of points written
+        """
+        written = 0
+
+        with self._flush_lock:
+            while True:
+                batch = self._drain()
+                if not batch:
+                    break
+
+                try:
+                    self.sink.write(batch)
+                    written += len(batch)
+                except Exception as e:
+                    self.dropped += len(batch)
+                    logger.error("Failed to write %d metric points: %s", len(batch), e)
+
+        return written
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._running and len(self._buffer) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                running = self._running
+
+            if not running:
+                break
+
+            self.flush()
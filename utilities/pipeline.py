@@ -0,0 +1,254 @@
+"""
+pipeline.py
+
+Bulk transformation of tabular data with the utils text helpers.
+
+Rows are read in chunks, each column is passed through the transforms declared for it
+and the chunks are spread across a process pool. Results come back in input order and
+are written as they arrive, so CSV to CSV runs in bounded memory.
+
+    >>> spec = {
+    ...     "title": "slugify",
+    ...     "description": ["normalize_text", "clean_ascii"],
+    ...     "phone": ("format_phone_numbers", {"code": "NG"}),
+    ...     "account_no": ("encrypt_data", {"key": "secret"}),
+    ... }
+    >>> transform_file("products.csv", "products.clean.csv", spec, processes=8)
+
+Transforms are given by name (see TRANSFORMS), as (name, options) or as a module level
+function taking the value (it has to be picklable to reach the worker processes).
+"""
+
+import io
+import csv
+import base64
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+import tablib
+
+import utils
+from utils import chunks
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    return value
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def _slugify(value, delim=u"-"):
+    return utils.slugify(_text(value), delim) if value else value
+
+
+def _normalize_text(value):
+    return utils.normalize_text(_text(value))
+
+
+def _clean_ascii(value):
+    return utils.clean_ascii(_bytes(value))
+
+
+def _format_phone_numbers(value, code, separator=","):
+    return separator.join(utils.format_phone_numbers(_bytes(value), code)) if value else value
+
+
+def _encrypt_data(value, key):
+    """ same output as encrypt_data for a single value, without building a dict per value """
+    if value is None:
+        return value
+    return base64.b64encode(utils.encrypt_3des(_des_key(key), str(_bytes(value))))
+
+
+def _encrypt_data_pyaes(value, key):
+    if value is None:
+        return value
+    return base64.b64encode(utils.encrypt_pyaes(utils.build_aes_key(key), str(_bytes(value))))
+
+
+_des_keys = {}
+
+
+def _des_key(key):
+    if key not in _des_keys:
+        _des_keys[key] = utils.build_3des_key(key)
+    return _des_keys[key]
+
+
+TRANSFORMS = {
+    "slugify": _slugify,
+    "normalize_text": _normalize_text,
+    "clean_ascii": _clean_ascii,
+    "format_phone_numbers": _format_phone_numbers,
+    "encrypt_data": _encrypt_data,
+    "encrypt_data_pyaes": _encrypt_data_pyaes,
+}
+
+
+def compile_spec(headers, spec):
+    """
+    resolve a transform spec against the headers
+
+    :param headers: column names
+    :param spec: dict of column name -> transform(s)
+    :return: list of (column index, [(function, options)])
+    """
+    plan = []
+
+    for column, transforms in spec.items():
+        if column not in headers:
+            raise ValueError("Unknown column in transform spec: %s" % column)
+
+        if not isinstance(transforms, list):
+            transforms = [transforms]
+
+        steps = []
+        for transform in transforms:
+            name, options = transform if isinstance(transform, tuple) else (transform, {})
+
+            if callable(name):
+                steps.append((name, options))
+            elif name in TRANSFORMS:
+                steps.append((TRANSFORMS[name], options))
+            else:
+                raise ValueError("Unknown transform: %s" % name)
+
+        plan.append((headers.index(column), steps))
+
+    return plan
+
+
+def transform_chunk(args):
+    """ apply a compiled plan to a chunk of rows """
+    plan, rows = args
+    result = []
+
+    for row in rows:
+        row = list(row)
+        for index, steps in plan:
+            value = row[index]
+            for func, options in steps:
+                value = func(value, **options)
+            row[index] = value
+        result.append(row)
+
+    return result
+
+
+def transform_rows(headers, rows, spec, processes=None, chunk_size=5000):
+    """
+    transform rows, yielding them in input order
+
+    :param headers: column names
+    :param rows: iterable of rows (sequences)
+    :param spec: dict of column name -> transform(s)
+    :param processes: worker processes, defaults to the number of cpus. 1 runs in this process
+    :param chunk_size: rows per task
+    """
+    plan = compile_spec(list(headers), spec)
+    processes = processes or cpu_count()
+
+    if processes == 1:
+        for chunk in chunks(rows, chunk_size):
+            for row in transform_chunk((plan, chunk)):
+                yield row
+        return
+
+    pool = Pool(processes)
+    pending = deque()
+
+    try:
+        for chunk in chunks(rows, chunk_size):
+            pending.append(pool.apply_async(transform_chunk, ((plan, chunk),)))
+
+            # bound the chunks in flight so memory does not grow with the input
+            if len(pending) >= processes * 2:
+                for row in pending.popleft().get():
+                    yield row
+
+        while pending:
+            for row in pending.popleft().get():
+                yield row
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def transform_dataset(dataset, spec, processes=None, chunk_size=5000):
+    """
+    transform a tablib dataset
+
+    :return: new tablib.Dataset
+    """
+    result = tablib.Dataset(headers=dataset.headers)
+
+    for row in transform_rows(dataset.headers, iter(dataset), spec, processes, chunk_size):
+        result.append(row)
+
+    return result
+
+
+def _read_csv(f):
+    for row in csv.reader(f):
+        yield [value.decode("utf-8") for value in row]
+
+
+def transform_file(src, dest, spec, processes=None, chunk_size=5000, format=None):
+    """
+    transform a file. CSV input is read and CSV output is written incrementally, other formats
+    supported by tablib (xlsx, json, ...) are loaded and exported as a whole
+
+    :param src: source path
+    :param dest: destination path
+    :param format: input format, defaults to the extension of src
+    :return: number of rows written
+    """
+    format = format or src.rsplit(".", 1)[-1].lower()
+    out_format = dest.rsplit(".", 1)[-1].lower()
+
+    if format == "csv":
+        f = open(src, "rb")
+        reader = _read_csv(f)
+        headers = next(reader, [])
+    else:
+        f = None
+        with open(src, "rb") as _f:
+            dataset = tablib.Dataset().load(_f.read(), format=format)
+        headers, reader = dataset.headers, iter(dataset)
+
+    count = 0
+
+    try:
+        rows = transform_rows(headers, reader, spec, processes, chunk_size)
+
+        if out_format == "csv":
+            with open(dest, "wb") as out:
+                writer = csv.writer(out)
+                writer.writerow([_bytes(h) for h in headers])
+                for row in rows:
+                    writer.writerow([_bytes(value) for value in row])
+                    count += 1
+        else:
+            result = tablib.Dataset(headers=headers)
+            for row in rows:
+                result.append(row)
+                count += 1
+
+            data = result.export(out_format)
+            with io.open(dest, "wb") as out:
+                out.write(_bytes(data))
+    finally:
+        if f is not None:
+            f.close()
+
+    return count
@@ -0,0 +1,257 @@
+"""
+profiling.py
+
+Opt-in profiling of the public functions in utilities.utils and the methods of the
+service classes generated by ServiceLabs.create_instance.
+
+Profiling is switched on with the UTILITIES_PROFILE environment variable (read when
+`utilities` is imported), from a config mapping with `configure`, or with `enable`.
+While it is off nothing is wrapped, so the functions run without any overhead.
+
+    $ UTILITIES_PROFILE=1 UTILITIES_PROFILE_SAMPLE=0.01 python app.py
+
+    >>> from utilities import profiling
+    >>> profiling.stats()["utils.slugify"]
+    {'calls': 1200, 'total': 0.021, 'mean': 1.7e-05, 'p50': 1.5e-05, 'p90': 2.4e-05, 'p99': 6.1e-05, 'max': 0.0002}
+    >>> profiling.dump("/tmp/profile.json")
+    >>> profiling.reset()
+
+Functions imported by name before profiling is enabled (`from utilities.utils import slugify`)
+keep pointing at the unwrapped function, so enable it at startup.
+"""
+
+import os
+import json
+import time
+import random
+import inspect
+import cProfile
+import pstats
+import threading
+import functools
+import weakref
+from collections import deque
+
+
+SAMPLES = 1024
+
+# service class methods called by the service API methods, left unwrapped so their time is
+# only counted in the API method that called them
+SERVICE_HELPERS = frozenset(["session", "prepare", "filter_query", "filter_template", "view_filter", "count_key",
+                             "cached_count", "store_count", "count_statement"])
+
+_lock = threading.Lock()
+_local = threading.local()
+_state = {"enabled": False, "sample_rate": 0.0}
+_stats = {}
+_profiles = {}
+_originals = {}
+_classes = weakref.WeakKeyDictionary()
+
+
+class FunctionStats(object):
+    """ call count, cumulative time and the most recent latencies of a function """
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=SAMPLES)
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        self.samples.append(elapsed)
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def percentile(self, values, p):
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+    def to_dict(self):
+        values = sorted(self.samples)
+        return {
+            "calls": self.calls,
+            "total": self.total,
+            "mean": self.total / self.calls if self.calls else 0.0,
+            "p50": self.percentile(values, 50),
+            "p90": self.percentile(values, 90),
+            "p99": self.percentile(values, 99),
+            "max": self.max
+        }
+
+
+def _record(label, elapsed, profile=None):
+    with _lock:
+        entry = _stats.get(label)
+        if entry is None:
+            entry = _stats[label] = FunctionStats()
+        entry.add(elapsed)
+
+        if profile is not None:
+            if label in _profiles:
+                _profiles[label].add(profile)
+            else:
+                _profiles[label] = pstats.Stats(profile)
+
+
+def wrap(func, label):
+    """ wrap a function to record its latency and, for a sample of calls, a cProfile capture """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # nested calls are timed but not captured, only one profiler can run per thread
+        if _state["sample_rate"] and not getattr(_local, "active", False) and random.random() < _state["sample_rate"]:
+            profile = cProfile.Profile()
+            _local.active = True
+            start = time.time()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                _local.active = False
+                _record(label, elapsed, profile)
+
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _record(label, time.time() - start)
+
+    wrapper._profiled = func
+    return wrapper
+
+
+def _patch(owner, name, value):
+    _originals.setdefault((owner, name), owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name))
+    setattr(owner, name, value)
+
+
+def instrument_module(module, prefix, namespaces=()):
+    """
+    wrap the public functions defined in a module
+
+    :param module: module to instrument
+    :param prefix: label prefix e.g. "utils"
+    :param namespaces: other modules that re-export the functions (e.g. the `utilities` package)
+    """
+    for name, func in list(vars(module).items()):
+        if name.startswith("_") or not inspect.isfunction(func) or func.__module__ != module.__name__:
+            continue
+
+        wrapper = wrap(func, "%s.%s" % (prefix, name))
+        _patch(module, name, wrapper)
+
+        for namespace in namespaces:
+            if getattr(namespace, name, None) is func:
+                _patch(namespace, name, wrapper)
+
+
+def instrument_class(cls, prefix, exclude=SERVICE_HELPERS):
+    """
+    wrap the public classmethods and staticmethods of a class
+
+    :param exclude: names of the methods left unwrapped
+    """
+    for name, attr in list(cls.__dict__.items()):
+        if name.startswith("_") or name in exclude or not isinstance(attr, (classmethod, staticmethod)):
+            continue
+
+        if getattr(attr.__func__, "_profiled", None) is not None:
+            continue
+
+        _patch(cls, name, type(attr)(wrap(attr.__func__, "%s.%s" % (prefix, name))))
+
+
+def register_class(cls, prefix):
+    """ register a generated service class, instrumenting it now if profiling is enabled """
+    _classes[cls] = prefix
+    if _state["enabled"]:
+        instrument_class(cls, prefix)
+
+
+def is_enabled():
+    return _state["enabled"]
+
+
+def enable(sample_rate=0.0):
+    """
+    start profiling the utils functions and the service classes
+
+    :param sample_rate: fraction of calls captured with cProfile (0 disables captures)
+    """
+    import utilities
+    from utilities import utils
+
+    with _lock:
+        _state["sample_rate"] = float(sample_rate)
+        if _state["enabled"]:
+            return
+        _state["enabled"] = True
+
+    instrument_module(utils, "utils", [utilities])
+    for cls, prefix in list(_classes.items()):
+        instrument_class(cls, prefix)
+
+
+def disable():
+    """ stop profiling and restore the original functions. collected stats are kept """
+    with _lock:
+        _state["enabled"] = False
+        _state["sample_rate"] = 0.0
+        originals = list(_originals.items())
+        _originals.clear()
+
+    for (owner, name), value in originals:
+        setattr(owner, name, value)
+
+
+def configure(config=None):
+    """
+    enable profiling from a config mapping (e.g. a flask app.config), falling back to the environment.
+    reads UTILITIES_PROFILE (on/off) and UTILITIES_PROFILE_SAMPLE (cProfile sample rate)
+    """
+    config = os.environ if config is None else config
+    if str(config.get("UTILITIES_PROFILE", "")).lower() in ("1", "true", "yes", "on"):
+        enable(float(config.get("UTILITIES_PROFILE_SAMPLE", 0) or 0))
+
+
+def stats():
+    """ return the collected stats (times in seconds) by function """
+    with _lock:
+        return dict((label, entry.to_dict()) for label, entry in _stats.items())
+
+
+def profiles():
+    """ return the aggregated cProfile captures (pstats.Stats) by function """
+    with _lock:
+        return dict(_profiles)
+
+
+def dump(path=None, profile_dir=None):
+    """
+    dump the collected stats as json
+
+    :param path: file to write the stats to, otherwise they are returned as a string
+    :param profile_dir: directory to write the cProfile captures to, one `<function>.prof` file each
+    """
+    data = json.dumps(stats(), indent=2, sort_keys=True)
+
+    if profile_dir:
+        for label, profile in profiles().items():
+            profile.dump_stats(os.path.join(profile_dir, "%s.prof" % label))
+
+    if path is None:
+        return data
+
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def reset():
+    """ clear the collected stats and captures """
+    with _lock:
+        _stats.clear()
+        _profiles.clear()
@@ -5,23 +5,34 @@ from unicodedata import normalize
 from datetime import datetime, date
 from email.utils import formatdate
 from calendar import timegm
-from user_agents import parse
-import requests
 import os
 import string
 import random
-import phonenumbers
 import hashlib
+import hmac
 import uuid
-import pyaes
-
-import htmlmin
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
-from cryptography.hazmat.backends import default_backend
-from PIL import Image as PImage
-
-from pygeocoder import Geocoder
+import io
+from decimal import Decimal
+from itertools import islice
+from urllib import urlencode, quote_plus
+
+from utilities.lazy import LazyImport
+from utilities.cache import memoize
+
+# heavy dependencies are imported on first use
+parse = LazyImport("user_agents", "parse", globals(), "parse")
+requests = LazyImport("requests", namespace=globals(), name="requests")
+phonenumbers = LazyImport("phonenumbers", namespace=globals(), name="phonenumbers")
+pyaes = LazyImport("pyaes", namespace=globals(), name="pyaes")
+htmlmin = LazyImport("htmlmin", namespace=globals(), name="htmlmin")
+Cipher = LazyImport("cryptography.hazmat.primitives.ciphers", "Cipher", globals(), "Cipher")
+algorithms = LazyImport("cryptography.hazmat.primitives.ciphers.algorithms", namespace=globals(), name="algorithms")
+modes = LazyImport("cryptography.hazmat.primitives.ciphers.modes", namespace=globals(), name="modes")
+padding = LazyImport("cryptography.hazmat.primitives.padding", namespace=globals(), name="padding")
+default_backend = LazyImport("cryptography.hazmat.backends", "default_backend", globals(), "default_backend")
+PImage = LazyImport("PIL.Image", namespace=globals(), name="PImage")
+Geocoder = LazyImport("pygeocoder", "Geocoder", globals(), "Geocoder")
+tablib = LazyImport("tablib", namespace=globals(), name="tablib")
 
 
 aes_secret_key = os.environ.get("AES_SECRET_KEY","")
@@ -177,6 +188,7 @@ def remove_empty_keys(data):
     return res
 
 
+@memoize("detect_user_agent")
 def detect_user_agent(ua_string):
     """
     Detects what kind of device is being used to access the server
@@ -271,6 +283,31 @@ def build_page_url(path, data, p):
     return str(path)+"?"+str(args)
 
 
+class PageUrlTemplate(object):
+    """
+    Page links for a listing. The query string is url encoded once and each link only
+    appends the page number
+
+        >>> urls = PageUrlTemplate("/products", {"q": "red shoes", "page": 1})
+        >>> urls(3)
+        '/products?q=red+shoes&page=3'
+    """
+
+    def __init__(self, path, data, page_param="page"):
+        args = [(_url_value(k), _url_value(v)) for k, v in sorted(data.items()) if k != page_param]
+        query = urlencode(args)
+        self.prefix = "%s?%s%s=" % (path, query + "&" if query else "", quote_plus(page_param))
+
+    def __call__(self, page):
+        return self.prefix + str(page)
+
+
+def _url_value(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
 def id_generator(size=10, chars=string.ascii_letters+string.digits):
     """
     utility function to generate random identification numbers
@@ -293,10 +330,116 @@ def number_format(value):
     return "{:,.2f}".format(float(value))
 
 
+def format_numbers(values, mode="fixed", precision=2, symbol=u"\u20a6", grouping=True):
+    """
+    Formats a batch of numbers. With the defaults every value is formatted exactly like number_format
+
+    :param values: list of numbers (or anything float() accepts) or a NumPy array
+    :param mode: "fixed", "currency" (symbol before the amount, after the sign) or "percent" (0.125 -> 12.50%)
+    :param precision: number of decimal places
+    :param symbol: currency symbol
+    :param grouping: add thousands separators
+
+    :returns: list of formatted strings
+    """
+    if mode not in ("fixed", "currency", "percent"):
+        raise ValueError("Invalid number format mode: %s" % mode)
+
+    spec = "{:%s.%d%s}" % ("," if grouping else "", int(precision), "%" if mode == "percent" else "f")
+    fmt = spec.format
+
+    # arrays are converted to python floats in one call instead of one float() per element
+    values = values.tolist() if hasattr(values, "tolist") else values
+    result = map(fmt, map(float, values))
+
+    if mode == "currency":
+        result = [u"-%s%s" % (symbol, v[1:]) if v[0] == "-" else symbol + v for v in result]
+
+    return result
+
+
 def is_list(value):
     return isinstance(value, (list, tuple))
 
 
+def chunks(iterable, size):
+    """ split an iterable into lists of at most size items """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+_date_encoder = DateJSONEncoder()
+
+
+def format_export_value(value):
+    """ format a value for exports: amounts with number_format and dates like DateJSONEncoder """
+    if isinstance(value, (float, Decimal)):
+        return number_format(value)
+
+    if isinstance(value, (datetime, date)):
+        return _date_encoder.default(value)
+
+    return value
+
+
+def export_rows(fileobj, format, headers, rows, batch_size=1000, formatters=None, encoding="utf-8"):
+    """
+    Write rows to a file-like object as csv or json, one tablib dataset per batch,
+    so only batch_size rows are held in memory at a time
+
+    :param fileobj: file-like object to write to
+    :param format: "csv" or "json"
+    :param headers: column names
+    :param rows: iterable of row tuples
+    :param batch_size: rows per batch
+    :param formatters: dict of column name -> function, used instead of format_export_value
+    :param encoding: encoding used when fileobj is not a text stream
+    :return: number of rows written
+    """
+    if format not in ("csv", "json"):
+        raise ValueError("Unsupported export format: %s" % format)
+
+    formatters = formatters or {}
+    funcs = [formatters.get(h, format_export_value) for h in headers]
+    text = isinstance(fileobj, io.TextIOBase)
+
+    def write(data):
+        if not text and isinstance(data, unicode):
+            data = data.encode(encoding)
+        fileobj.write(data)
+
+    count = 0
+    if format == "json":
+        write(u"[")
+
+    for batch in chunks(rows, batch_size):
+        dataset = tablib.Dataset()
+        # csv headers are only written with the first batch, json objects need them on every batch
+        if format == "json" or not count:
+            dataset.headers = headers
+
+        for row in batch:
+            dataset.append([f(v) for f, v in zip(funcs, row)])
+
+        data = dataset.export(format)
+        if format == "json":
+            data = (u"," if count else u"") + data[1:-1]
+
+        write(data)
+        count += len(batch)
+
+    if format == "json":
+        write(u"]")
+    elif not count:
+        write(u",".join(headers) + u"\r\n")
+
+    return count
+
+
 def check_image_size(src, dimensions=(200, 200)):
     """ Check's image dimensions """
     img = PImage.open(src)
@@ -406,6 +549,7 @@ def generate_code(prefix, length):
     return '{}-{}'.format(prefix, suffix).upper()
 
 
+@memoize("compute_lat_lng")
 def compute_lat_lng(address):
     try:
         result = Geocoder.geocode(address)
@@ -569,6 +713,51 @@ def decrypt_data_pyaes(key, data):
     return decrypted_data
 
 
+def build_index_key(key):
+    """ derive the blind index key from a secret so it differs from the encryption keys """
+
+    return hmac.new(key, "blind-index", hashlib.sha256).digest()
+
+
+def _blind_index(index_key, value, normalize=None):
+    """ hash a plain value with a key from build_index_key """
+
+    if normalize:
+        value = normalize(value)
+
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+
+    return hmac.new(index_key, str(value), hashlib.sha256).hexdigest()[:32]
+
+
+def blind_index(key, value, normalize=None):
+    """
+    keyed hash of a plain value, stored next to its encrypted field so the field can be
+    looked up without decrypting. equal values give equal indexes
+    :param key: blind index secret
+    :param value: plain value
+    :param normalize: optional function applied to the value first, returning a string
+        (e.g. lambda v: v.strip().lower() for emails)
+    :returns: 32 character hex digest
+    """
+
+    return _blind_index(build_index_key(key), value, normalize)
+
+
+def blind_index_data(key, data, fields=None, suffix="_bidx", normalize=None):
+    """ compute the blind indexes of the fields of data (all of them by default), keyed by field + suffix """
+
+    index_key = build_index_key(key)
+    indexes = dict()
+
+    for k, v in data.items():
+        if fields is None or k in fields:
+            indexes["%s%s" % (k, suffix)] = _blind_index(index_key, v, normalize)
+
+    return indexes
+
+
 def dict_update(dic, data):
     """
 
@@ -618,6 +807,7 @@ def decrypt_string_to_dict(cipher_text):
     return data
 
 
+@memoize("render_domain_template", ttl=300, opt_in=True)
 def render_domain_template(name, **kwargs):
     from flask import render_template
     template_name = name
@@ -0,0 +1,209 @@
+"""
+writebuffer.py
+
+Write-behind buffer for high frequency updates to the rows of a model.
+
+Increments and field updates are coalesced per id in memory (increments add up, updates are
+last write wins) and written by a background thread as batched UPDATE statements, one
+executemany per combination of columns, when `max_pending` ids are buffered or every
+`flush_interval` seconds. Whatever is still buffered is flushed when the buffer is stopped,
+which happens at interpreter exit.
+
+    >>> service = ServiceLabs.create_instance(Product, db)
+    >>> writes = service.write_buffer()
+    >>> writes.increment(product.id, views=1)
+    >>> writes.update(product.id, last_viewed=datetime.utcnow())
+
+Buffered writes bypass the session, so objects already loaded in a session will not see them
+until they are refreshed.
+"""
+
+import time
+import threading
+import atexit
+from logging import getLogger
+
+from sqlalchemy import bindparam
+from sqlalchemy.orm import class_mapper
+
+
+logger = getLogger(__name__)
+
+
+def _apply(state, values, deltas):
+    """ apply updates then increments to a pending (values, deltas) state """
+    for key, value in values.items():
+        state[0][key] = value
+        state[1].pop(key, None)
+
+    for key, delta in deltas.items():
+        if key in state[0]:
+            state[0][key] = state[0][key] + delta
+        else:
+            state[1][key] = state[1].get(key, 0) + delta
+
+
+class WriteBuffer(object):
+    """ coalesces increments and updates per id and writes them in batches """
+
+    def __init__(self, model, engine, max_pending=1000, flush_interval=1.0):
+        """
+        :param model: model class
+        :param engine: engine the updates are executed with
+        :param max_pending: number of buffered ids that triggers a flush
+        :param flush_interval: seconds between time triggered flushes
+        """
+        mapper = class_mapper(model)
+
+        self.model = model
+        self.engine = engine
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.table = mapper.local_table
+        self.primary_key = mapper.primary_key[0]
+        self.columns = dict((attr.key, attr.columns[0]) for attr in mapper.column_attrs)
+        self.written = 0
+
+        self._pending = {}
+        self._statements = {}
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """ start the background flush thread """
+        if self._running:
+            return self
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="write-buffer-%s" % self.table.name)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+        return self
+
+    def stop(self, timeout=None):
+        """ stop the background thread and flush whatever is still buffered """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+        self.flush()
+
+    def _check(self, fields):
+        for key in fields:
+            if key not in self.columns:
+                raise ValueError("Unknown column for %s: %s" % (self.model.__name__, key))
+
+    def _record(self, obj_id, values, deltas):
+        with self._condition:
+            state = self._pending.get(obj_id)
+            if state is None:
+                state = self._pending[obj_id] = ({}, {})
+
+            _apply(state, values, deltas)
+
+            if len(self._pending) >= self.max_pending:
+                self._condition.notify()
+
+    def increment(self, obj_id, **deltas):
+        """
+        add to numeric columns of the object with id obj_id
+        :param obj_id:
+        :param deltas: column -> amount
+        """
+        self._check(deltas)
+        self._record(obj_id, {}, deltas)
+
+    def update(self, obj_id, **values):
+        """
+        set columns of the object with id obj_id, the last value buffered wins
+        :param obj_id:
+        :param values: column -> value
+        """
+        self._check(values)
+        self._record(obj_id, values, {})
+
+    def pending(self):
+        """ number of ids currently buffered """
+        return len(self._pending)
+
+    def _statement(self, set_keys, increment_keys):
+        key = (set_keys, increment_keys)
+        statement = self._statements.get(key)
+
+        if statement is None:
+            values = {}
+            for name in set_keys:
+                values[self.columns[name]] = bindparam("v_%s" % name)
+            for name in increment_keys:
+                column = self.columns[name]
+                values[column] = column + bindparam("d_%s" % name)
+
+            statement = self.table.update().where(self.primary_key == bindparam("pk_")).values(values)
+            self._statements[key] = statement
+
+        return statement
+
+    def _write(self, batch):
+        groups = {}
+
+        for obj_id, (values, deltas) in batch.items():
+            params = {"pk_": obj_id}
+            for name, value in values.items():
+                params["v_%s" % name] = value
+            for name, delta in deltas.items():
+                params["d_%s" % name] = delta
+
+            groups.setdefault((tuple(sorted(values)), tuple(sorted(deltas))), []).append(params)
+
+        with self.engine.begin() as conn:
+            for (set_keys, increment_keys), params in groups.items():
+                conn.execute(self._statement(set_keys, increment_keys), params)
+
+    def flush(self):
+        """
+        write all buffered changes in one transaction. on failure they are put back in the
+        buffer, ahead of anything buffered since, and the error is raised
+        :return: number of ids written
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, {}
+
+            if not batch:
+                return 0
+
+            try:
+                self._write(batch)
+            except:
+                with self._condition:
+                    for obj_id, state in self._pending.items():
+                        _apply(batch.setdefault(obj_id, ({}, {})), state[0], state[1])
+                    self._pending = batch
+                raise
+
+            self.written += len(batch)
+            return len(batch)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._running and len(self._pending) < self.max_pending:
+                    self._condition.wait(self.flush_interval)
+                running = self._running
+
+            if not running:
+                break
+
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Failed to write buffered %s updates: %s", self.model.__name__, e)
+                time.sleep(self.flush_interval)